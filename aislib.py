@@ -11,8 +11,11 @@ A LICENSE file should have accompanied this program.
  
 """
 
-import bitstring
 import binascii
+import collections
+import operator
+import string
+import time
     
 # Create a character encoding and reversed character encoding map which
 # we will use to encode and decode, respectively, AIS bit streams
@@ -39,10 +42,23 @@ for i in range(len(AISchars)):
     re_AISchars[AISchars[i]] = i
 
 def AISString2Bits(name,length=20):
+    # bitstring is only needed by code that still builds bitstreams
+    import bitstring
     if len(name)>length: name = name[:length]
     if len(name)<length: name = name+'@'*(length-len(name))
     return bitstring.Bits().join(['uint:6=%d' % re_AISchars[name[k]] for k in range(len(name))])
 
+def AISBits2String(bits, length=20):
+    """
+    Converts a text field, as the integer from get_attr, back to a string,
+    dropping the @ padding
+    """
+
+    chars = []
+    for k in range(length - 1, -1, -1):
+        chars.append(AISchars[(bits >> (6 * k)) & 0x3f])
+    return "".join(chars).rstrip('@').rstrip()
+
 def int2bin6(num):
     """
     Converts the given integer to a 6-bit binary representation
@@ -50,109 +66,322 @@ def int2bin6(num):
     
     return "".join(num & (1 << i) and '1' or '0' for i in range(5, -1, -1))
 
+def payload_bits(payload, start, size):
+    """
+    Decodes just bits start to start + size of an armored payload, from
+    the few characters that hold them, as an unsigned integer. Bits past
+    the end of the payload are zero. Raises ValueError if the characters
+    are not armored.
+    """
+
+    first = start // 6
+    last = (start + size + 5) // 6
+    bits = 0
+    try:
+        for c in payload[first:last]:
+            bits = (bits << 6) | re_encodingchars[c]
+    except KeyError:
+        raise ValueError("Invalid character in AIS payload.")
+    # zeros for any characters missing from the end
+    bits <<= 6 * (last - first - len(payload[first:last]))
+    return (bits >> (last * 6 - start - size)) & ((1 << size) - 1)
+
+# bit offsets of the longitude and latitude in each kind of position report
+POSITION_FIELDS = {1: (61, 89), 2: (61, 89), 3: (61, 89), 18: (57, 85), 19: (57, 85)}
+
+def payload_position(payload, ais_type):
+    """
+    Decodes just the position from an armored position report payload of
+    the given type. Returns (latitude, longitude) in degrees, or None if
+    the position is not available or the payload is too short.
+    """
+
+    fields = POSITION_FIELDS.get(ais_type)
+    if fields is None:
+        return None
+    lon_start, lat_start = fields
+    end = lat_start + 27
+    chars = (end + 5) // 6
+    if len(payload) < chars:
+        return None
+    bits = 0
+    try:
+        for c in payload[:chars]:
+            bits = (bits << 6) | re_encodingchars[c]
+    except KeyError:
+        return None
+    bits >>= chars * 6 - end
+    lat = bits & 0x7ffffff
+    lon = (bits >> 27) & 0xfffffff
+    # two's complement
+    if lat & 0x4000000:
+        lat -= 0x8000000
+    if lon & 0x8000000:
+        lon -= 0x10000000
+    # 91 and 181 degrees mean not available
+    if lat == 91 * 600000 or lon == 181 * 600000:
+        return None
+    return lat / 600000.0, lon / 600000.0
+
+def nmea_checksum(body):
+    """
+    XOR of all the characters of a sentence body (between the ! or $ and
+    the *), done in one pass over a bytearray rather than character by
+    character
+    """
+
+    return reduce(operator.xor, bytearray(body), 0)
+
 class CRCInvalidError(Exception):
     pass
 
+# Six-bit armoring. The armored characters carry 6 bits each, just as the
+# characters of base64 do, so a payload is translated to the base64
+# alphabet and converted to and from bytes by binascii, in C, rather than
+# a character at a time
+_BASE64 = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+_to_base64 = string.maketrans("".join(encodingchars), _BASE64)
+_from_base64 = string.maketrans(_BASE64, "".join(encodingchars))
+_not_armored = "".join(c for c in map(chr, range(256)) if c not in re_encodingchars)
+
+def armor(bits, length):
+    """
+    Armors the length bit integer bits, returning the payload characters
+    and the number of fill bits added to make up the last character
+    """
+
+    fillbits = -length % 6
+    chars = (length + fillbits) // 6
+    if not chars:
+        return '', 0
+    # base64 works in groups of 4 characters, 3 bytes
+    pad = -chars % 4
+    data = binascii.unhexlify('%0*x' % ((chars + pad) * 3 // 2, bits << (fillbits + pad * 6)))
+    return binascii.b2a_base64(data)[:chars].translate(_from_base64), fillbits
+
+def unarmor(payload, fillbits=0):
+    """
+    Returns the integer held by an armored payload, and its length in bits.
+    Raises ValueError if the payload holds a character that is not armored.
+    """
+
+    chars = len(payload)
+    if not chars:
+        return 0, 0
+    text = payload.translate(_to_base64, _not_armored)
+    if len(text) != chars:
+        raise ValueError("Invalid character in AIS payload.")
+    pad = -chars % 4
+    bits = int(binascii.hexlify(binascii.a2b_base64(text + 'A' * pad)), 16)
+    return bits >> (fillbits + pad * 6), chars * 6 - fillbits
+
+# Code generated for each message type's pack and unpack routines
+_PACK_TEMPLATE = '''
+def pack(values):
+    return (%s)
+'''
+
+_UNPACK_TEMPLATE = '''
+def unpack(bits):
+    values = {
+%s
+    }
+%s
+    return values
+'''
+
+def compile_fields(fields):
+    """
+    Compiles a message's field table, a list of (name, type, bits) in
+    transmission order, into plain integer routines:
+
+        pack(values)    the message as one integer, from a dict of field values
+        unpack(bits)    a dict of field values, from the message as one integer
+
+    Field offsets, masks and sign handling are worked out once here rather
+    than every time a message is encoded or decoded.
+    """
+
+    length = sum(bits for name, kind, bits in fields)
+    terms = ['0']
+    items = []
+    signed = []
+    offset = length
+    for name, kind, bits in fields:
+        offset -= bits
+        mask = (1 << bits) - 1
+        terms.append("((values[%r] & %d) << %d)" % (name, mask, offset))
+        items.append("        %r: (bits >> %d) & %d," % (name, offset, mask))
+        if kind == 'int':
+            # two's complement
+            signed.append("    if values[%r] >> %d:" % (name, bits - 1))
+            signed.append("        values[%r] -= %d" % (name, 1 << bits))
+    namespace = {}
+    exec (_PACK_TEMPLATE % " |\n        ".join(terms)) in namespace
+    exec (_UNPACK_TEMPLATE % ("\n".join(items), "\n".join(signed))) in namespace
+    return namespace['pack'], namespace['unpack'], length
+
+def AISString2Int(name, length=20):
+    """
+    Converts a string to the integer value of a text field of length
+    characters, padded with @
+    """
+
+    name = name[:length].upper()
+    value = 0
+    for c in name + '@' * (length - len(name)):
+        value = (value << 6) | re_AISchars.get(c, 0)
+    return value
+
+def message_class(msgId, partno=0):
+    """
+    Returns the AISMessage class for a message type and, for type 24, part
+    number, or None if the type is not supported
+    """
+
+    # types 2 and 3 are position reports in the same format as type 1
+    if msgId in (1, 2, 3):
+        return AISPositionReportMessage
+    if msgId == 5:
+        return AISStaticAndVoyageReportMessage
+    if msgId == 24:
+        if partno == 0:
+            return AISStaticDataReportAMessage
+        if partno == 1:
+            return AISStaticDataReportBMessage
+    return None
+
+def decode_payload(payload, fillbits=0):
+    """
+    Decodes an armored AIS payload, with the payloads of all the fragments
+    of a multi-sentence message joined together, into an AISMessage.
+    Returns None if the message type is not supported.
+    """
+
+    bits, length = unarmor(payload, fillbits)
+    if length < 40:
+        return None
+    cls = message_class(bits >> (length - 6), (bits >> (length - 40)) & 3)
+    if cls is None:
+        return None
+    # a short message is padded with zeros, spare bits after it dropped
+    if length < cls.length:
+        bits <<= cls.length - length
+    elif length > cls.length:
+        bits >>= length - cls.length
+    aismsg = cls.__new__(cls)
+    object.__setattr__(aismsg, '_values', cls._unpack(bits))
+    return aismsg
+
 class AISMessage(object):
-    # Contain our AIS message elements
-    _attrs = {}
-    
-    # Map the number of bits for each element in the AIS message
-    _bitmap = {}
-    
+    """
+    Base class of the AIS messages. Each sub-class lists its fields, in the
+    order they are sent, as (name, type, bits) in FIELDS; the list is
+    compiled into pack and unpack routines when the class is defined.
+
+    Field values are plain integers, read and set as attributes of the
+    message, e.g. aismsg.mmsi.
+    """
+
+    FIELDS = ()
+
+    class __metaclass__(type):
+        def __init__(cls, name, bases, namespace):
+            type.__init__(cls, name, bases, namespace)
+            pack, unpack, cls.length = compile_fields(cls.FIELDS)
+            cls._pack, cls._unpack = staticmethod(pack), staticmethod(unpack)
+            cls._bitmap = dict((name, [kind, bits]) for name, kind, bits in cls.FIELDS)
+            # name : (offset, bits, signed), for decoding one field at a time
+            cls._offsets = {}
+            offset = 0
+            for name, kind, bits in cls.FIELDS:
+                cls._offsets[name] = (offset, bits, kind == 'int')
+                offset += bits
+
     def __init__(self, elements):
-        # Init our bit mapping and load up default message values
-        for key, arr in elements.items():
-            # arr[0] == data type of the element
-            # arr[1] == number of bits for given element
-            # arr[2] == the default value for the element
-            self._bitmap[key] = [ arr[0], arr[1] ]
-            
-            # Set default value
-            self.__setattr__(key, arr[2])
-        
+        object.__setattr__(self, '_values', {})
+        for key, value in elements.items():
+            self.__setattr__(key, value)
+
     def __getattr__(self, name):
         """
-        We are overriding the behavior of __getattr__ to implement dynamic class
-        properties. This way we can do stuff like [class].[property] without
-        requiring a "getter" method for each property.
-        
-        If the AIS message element is not found in our attribute table, we'll
-        revert to the default behavior of __getattr__
+        Field values are kept in a dictionary, and returned as attributes
         """
-        
-        if name in self._attrs:
-            return self._attrs[name]
-        
-        # Preserve the default behavior if our custom attributes were not found
-        return super(AISMessage, self).__getattr__(name)
-        
+
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError(name)
+
     def __setattr__(self, name, value):
         """
-        We are overriding the __setattr__ to implement dynamic property "setters".
+        Set a field, checking the value fits
         """
-        
-        if type(value) not in [ int ]:
-            raise TypeError("Value must be an integer.")
-            
-        if name == "_bitmap":
-            super(AISMessage, self).__setattr__(name, value)
-            
-        # Set attributes that are supported by the sub-classed AIS message type
-        elif name in self._bitmap:
-            # String format is: [datatype]:[num_bits]=[value]
-            self._attrs[name] = bitstring.Bits(
-                    "%s:%d=%d" % (self._bitmap[name][0], self._bitmap[name][1], value))
 
-        else:
+        if name not in self._bitmap:
             raise AttributeError("Unsupported AIS message element.")
-    
+        if type(value) not in (int, long):
+            raise TypeError("Value must be an integer.")
+        kind, bits = self._bitmap[name]
+        if kind == 'int':
+            low, high = -(1 << (bits - 1)), (1 << (bits - 1)) - 1
+        else:
+            low, high = 0, (1 << bits) - 1
+        if not low <= value <= high:
+            raise ValueError("%s must be between %d and %d" % (name, low, high))
+        self._values[name] = value
+
     def get_attr(self, name):
         """
-        Returns an integer representation of the binary value for the given 
-        element name.
-        
-        @param  name    Name of the AIS message element to retrieve
-        @return         Human readable int value. If invalid element, returns None
+        Returns the integer value of the given element name, or None if the
+        message has no such element
         """
-        
-        if name in self._attrs:
-            if self._bitmap[name][0] == "int":
-                return self._attrs[name].int
-            else:
-                return self._attrs[name].uint
-            
-        return None
-        
-    ## Sub-classes should implement the methods below ##
-    
+
+        return self._values.get(name)
+
+    def pack(self):
+        """
+        Returns the message as one integer of self.length bits
+        """
+
+        return self._pack(self._values)
+
     def build_bitstream(self):
         """
-        Build the bitstream which we will be using to encode the payload. This will
-        basically involve concatenating all the message elements into one bitstring.
-        
-        Sub-classes that extend the AISMessage class are required to implement this
-        method. Example implementation:
-        
-            return bitstring.Bits().join([
-                self.element_1, self.element_2, [...]
-            ])
+        Returns the message as a bitstring.Bits, for code that works with
+        the bitstring module
         """
-        pass
-    
+
+        import bitstring
+        return bitstring.Bits(uint=self.pack(), length=self.length)
+
     def unpack(self, bitstream):
         """
-        Unpack a bitstream into AIS message elements. Sub-classes can optionally
-        implement this method to support decoding of AIS messages. Example
-        implementation:
-            
-            self._attrs["element_1"] = bitstring.Bits(bin=bitstream[0:6])
-            self._attrs["element_2"] = bitstring.Bits(bin=bitstream[6:8])
-            [...]
+        Unpacks a string of '0' and '1' characters into the message's fields
         """
-        pass
-        
+
+        self._values.update(self._unpack(int(bitstream[:self.length].ljust(self.length, '0'), 2)))
+
 class AISPositionReportMessage(AISMessage):
+    FIELDS = (
+        ('id', 'uint', 6),
+        ('repeat', 'uint', 2),
+        ('mmsi', 'uint', 30),
+        ('status', 'uint', 4),
+        ('rot', 'int', 8),
+        ('sog', 'uint', 10),
+        ('pa', 'uint', 1),
+        ('lon', 'int', 28),
+        ('lat', 'int', 27),
+        ('cog', 'uint', 12),
+        ('heading', 'uint', 9),
+        ('ts', 'uint', 6),
+        ('smi', 'uint', 2),
+        ('spare', 'uint', 3),
+        ('raim', 'uint', 1),
+        ('comm_state', 'uint', 19),
+    )
+
     def __init__(self, id=1, repeat=0, mmsi=0, status=15, rot=-128, sog=0, pa=0,
                        lon=0, lat=0, cog=3600, heading=511, ts=60, smi=0, spare=0, 
                        raim=0, comm_state=0):
@@ -165,66 +394,49 @@ class AISPositionReportMessage(AISMessage):
         """
         
         super(AISPositionReportMessage, self).__init__({
-                    # message_element : ["data_type", num_bits, initial_value]
-                    'id'        : ["uint", 6, id], 
-                    'repeat'    : ["uint", 2, repeat], 
-                    'mmsi'      : ["uint", 30, mmsi], 
-                    'status'    : ["uint", 4, status], 
-                    'rot'       : ["int", 8, rot], 
-                    'sog'       : ["uint", 10, sog], 
-                    'pa'        : ["uint", 1, pa], 
-                    'lon'       : ["int", 28, lon], 
-                    'lat'       : ["int", 27, lat], 
-                    'cog'       : ["uint", 12, cog], 
-                    'heading'   : ["uint", 9, heading], 
-                    'ts'        : ["uint", 6, ts], 
-                    'smi'       : ["uint", 2, smi], 
-                    'spare'     : ["uint", 3, spare], 
-                    'raim'      : ["uint", 1, raim], 
-                    'comm_state' : ["uint", 19, comm_state]
+                    'id'        : id, 
+                    'repeat'    : repeat, 
+                    'mmsi'      : mmsi, 
+                    'status'    : status, 
+                    'rot'       : rot, 
+                    'sog'       : sog, 
+                    'pa'        : pa, 
+                    'lon'       : lon, 
+                    'lat'       : lat, 
+                    'cog'       : cog, 
+                    'heading'   : heading, 
+                    'ts'        : ts, 
+                    'smi'       : smi, 
+                    'spare'     : spare, 
+                    'raim'      : raim, 
+                    'comm_state' : comm_state
                 })
-    
-    def build_bitstream(self):
-        return bitstring.Bits().join([
-            self.id,
-            self.repeat,
-            self.mmsi,
-            self.status,
-            self.rot,
-            self.sog,
-            self.pa,
-            self.lon,
-            self.lat,
-            self.cog,
-            self.heading,
-            self.ts,
-            self.smi,
-            self.spare,
-            self.raim,
-            self.comm_state
-        ])
-    
-    def unpack(self, bitstream):
-        # TODO: figure out a better way to do this, but works fine for now
-        self._attrs["id"]       = bitstring.Bits(bin=bitstream[0:6])
-        self._attrs["repeat"]   = bitstring.Bits(bin=bitstream[6:8])
-        self._attrs["mmsi"]     = bitstring.Bits(bin=bitstream[8:38])
-        self._attrs["status"]   = bitstring.Bits(bin=bitstream[38:42])
-        self._attrs["rot"]      = bitstring.Bits(bin=bitstream[42:50])
-        self._attrs["sog"]      = bitstring.Bits(bin=bitstream[50:60])
-        self._attrs["pa"]       = bitstring.Bits(bin=bitstream[60:61])
-        self._attrs["lon"]      = bitstring.Bits(bin=bitstream[61:89])
-        self._attrs["lat"]      = bitstring.Bits(bin=bitstream[89:116])
-        self._attrs["cog"]      = bitstring.Bits(bin=bitstream[116:128])
-        self._attrs["heading"]  = bitstring.Bits(bin=bitstream[128:137])
-        self._attrs["ts"]       = bitstring.Bits(bin=bitstream[137:143])
-        self._attrs["smi"]      = bitstring.Bits(bin=bitstream[143:145])
-        self._attrs["spare"]    = bitstring.Bits(bin=bitstream[145:148])
-        self._attrs["raim"]     = bitstring.Bits(bin=bitstream[148:149])
-        self._attrs["comm_state"] = bitstring.Bits(bin=bitstream[149:168])
-            
 
 class AISStaticAndVoyageReportMessage(AISMessage):
+    FIELDS = (
+        ('id', 'uint', 6),
+        ('repeat', 'uint', 2),
+        ('mmsi', 'uint', 30),
+        ('ais_version', 'uint', 2),
+        ('imo', 'uint', 30),
+        ('callsign', 'uint', 42),
+        ('shipname', 'uint', 120),
+        ('shiptype', 'uint', 8),
+        ('to_bow', 'uint', 9),
+        ('to_stern', 'uint', 9),
+        ('to_port', 'uint', 6),
+        ('to_starboard', 'uint', 6),
+        ('epfd', 'uint', 4),
+        ('month', 'uint', 4),
+        ('day', 'uint', 5),
+        ('hour', 'uint', 5),
+        ('minute', 'uint', 6),
+        ('draught', 'uint', 8),
+        ('destination', 'uint', 120),
+        ('dte', 'uint', 1),
+        ('spare', 'uint', 1),
+    )
+
     def __init__(self, id=5, repeat=0, mmsi=0, ais_version=0, imo=0, callsign=0, shipname=0,
                        shiptype=0, to_bow=0, to_stern=0, to_port=0, to_starboard=0, epfd=1,
                        month=0, day=0, hour=24, minute=60, draught=0,
@@ -238,80 +450,39 @@ class AISStaticAndVoyageReportMessage(AISMessage):
         """
         
         super(AISStaticAndVoyageReportMessage, self).__init__({
-                    # message_element : ["data_type", num_bits, initial_value]
-                    'id'           : ["uint", 6, id], 
-                    'repeat'       : ["uint", 2, repeat], 
-                    'mmsi'         : ["uint", 30, mmsi], 
-                    'ais_version'  : ["uint", 2, ais_version], 
-                    'imo'          : ["uint", 30, imo], 
-                    'callsign'     : ["uint", 42, AISString2Bits(callsign,length=42/6).int if type(callsign) == str else callsign], 
-                    'shipname'     : ["uint", 120, AISString2Bits(shipname,length=120/6).int if type(shipname) == str else shipname], 
-                    'shiptype'     : ["uint", 8, shiptype], 
-                    'to_bow'       : ["uint", 9, to_bow], 
-                    'to_stern'     : ["uint", 9, to_stern], 
-                    'to_port'      : ["uint", 6, to_port], 
-                    'to_starboard' : ["uint", 6, to_starboard], 
-                    'epfd'         : ["uint", 4, epfd], 
-                    'month'        : ["uint", 4, month], 
-                    'day'          : ["uint", 5, day], 
-                    'hour'         : ["uint", 5, hour], 
-                    'minute'       : ["uint", 6, minute], 
-                    'draught'      : ["uint", 8, draught], 
-                    'destination'  : ["uint", 120, AISString2Bits(destination,length=120/6).int if type(destination) == str else destination], 
-                    'dte'          : ["uint", 1, dte], 
-                    'spare'        : ["uint", 1, spare]
+                    'id'           : id, 
+                    'repeat'       : repeat, 
+                    'mmsi'         : mmsi, 
+                    'ais_version'  : ais_version, 
+                    'imo'          : imo, 
+                    'callsign'     : AISString2Int(callsign, 42 // 6) if type(callsign) == str else callsign, 
+                    'shipname'     : AISString2Int(shipname, 120 // 6) if type(shipname) == str else shipname, 
+                    'shiptype'     : shiptype, 
+                    'to_bow'       : to_bow, 
+                    'to_stern'     : to_stern, 
+                    'to_port'      : to_port, 
+                    'to_starboard' : to_starboard, 
+                    'epfd'         : epfd, 
+                    'month'        : month, 
+                    'day'          : day, 
+                    'hour'         : hour, 
+                    'minute'       : minute, 
+                    'draught'      : draught, 
+                    'destination'  : AISString2Int(destination, 120 // 6) if type(destination) == str else destination, 
+                    'dte'          : dte, 
+                    'spare'        : spare
                 })
-    
-    def build_bitstream(self):
-        return bitstring.Bits().join([
-            self.id,
-            self.repeat,
-            self.mmsi,
-            self.ais_version,
-            self.imo,
-            self.callsign,
-            self.shipname,
-            self.shiptype,
-            self.to_bow,
-            self.to_stern,
-            self.to_port,
-            self.to_starboard,
-            self.epfd,
-            self.month,
-            self.day,
-            self.hour,
-            self.minute,
-            self.draught,
-            self.destination,
-            self.dte,
-            self.spare
-        ])
-    
-    def unpack(self, bitstream):
-        # TODO: figure out a better way to do this, but works fine for now
-        self._attrs["id"]       = bitstring.Bits(bin=bitstream[0:6])
-        self._attrs["repeat"]   = bitstring.Bits(bin=bitstream[6:8])
-        self._attrs["mmsi"]     = bitstring.Bits(bin=bitstream[8:38])
-        self._attrs["ais_version"]   = bitstring.Bits(bin=bitstream[38:40])
-        self._attrs["imo"]      = bitstring.Bits(bin=bitstream[40:70])
-        self._attrs["callsign"]      = bitstring.Bits(bin=bitstream[70:112])
-        self._attrs["shipname"]       = bitstring.Bits(bin=bitstream[112:232])
-        self._attrs["shiptype"]      = bitstring.Bits(bin=bitstream[232:240])
-        self._attrs["to_bow"]      = bitstring.Bits(bin=bitstream[240:249])
-        self._attrs["to_stern"]      = bitstring.Bits(bin=bitstream[249:258])
-        self._attrs["to_port"]  = bitstring.Bits(bin=bitstream[258:264])
-        self._attrs["to_starboard"]       = bitstring.Bits(bin=bitstream[264:270])
-        self._attrs["epfd"]      = bitstring.Bits(bin=bitstream[270:274])
-        self._attrs["month"]    = bitstring.Bits(bin=bitstream[274:278])
-        self._attrs["day"]     = bitstring.Bits(bin=bitstream[278:283])
-        self._attrs["hour"]     = bitstring.Bits(bin=bitstream[283:288])
-        self._attrs["minute"]     = bitstring.Bits(bin=bitstream[288:294])
-        self._attrs["draught"]     = bitstring.Bits(bin=bitstream[294:302])
-        self._attrs["destination"]     = bitstring.Bits(bin=bitstream[302:422])
-        self._attrs["dte"]     = bitstring.Bits(bin=bitstream[422:423])
-        self._attrs["spare"] = bitstring.Bits(bin=bitstream[423:424])
-            
+
 class AISStaticDataReportAMessage(AISMessage):
+    FIELDS = (
+        ('id', 'uint', 6),
+        ('repeat', 'uint', 2),
+        ('mmsi', 'uint', 30),
+        ('partno', 'uint', 2),
+        ('shipname', 'uint', 120),
+        ('spare', 'uint', 8),
+    )
+
     def __init__(self, id=24, repeat=0, mmsi=0, partno=0, shipname=0, spare=0):
         """
         Returns an instance of an AIS Static Data Report Message Format A class
@@ -322,36 +493,32 @@ class AISStaticDataReportAMessage(AISMessage):
         """
         
         super(AISStaticDataReportAMessage, self).__init__({
-                    # message_element : ["data_type", num_bits, initial_value]
-                    'id'              : ["uint", 6, id], 
-                    'repeat'          : ["uint", 2, repeat], 
-                    'mmsi'            : ["uint", 30, mmsi], 
-                    'partno'          : ["uint", 2, partno], 
-                    'shipname'        : ["uint", 120, AISString2Bits(shipname,length=120/6).int if type(shipname) == str else shipname], 
-                    'spare'           : ["uint", 8, spare]
+                    'id'              : id, 
+                    'repeat'          : repeat, 
+                    'mmsi'            : mmsi, 
+                    'partno'          : partno, 
+                    'shipname'        : AISString2Int(shipname, 120 // 6) if type(shipname) == str else shipname, 
+                    'spare'           : spare
                 })
-    
-    def build_bitstream(self):
-        return bitstring.Bits().join([
-            self.id,
-            self.repeat,
-            self.mmsi,
-            self.partno,
-            self.shipname,
-            self.spare
-        ])
-    
-    def unpack(self, bitstream):
-        # TODO: figure out a better way to do this, but works fine for now
-        self._attrs["id"]       = bitstring.Bits(bin=bitstream[0:6])
-        self._attrs["repeat"]   = bitstring.Bits(bin=bitstream[6:8])
-        self._attrs["mmsi"]     = bitstring.Bits(bin=bitstream[8:38])
-        self._attrs["partno"]   = bitstring.Bits(bin=bitstream[38:40])
-        self._attrs["shipname"]      = bitstring.Bits(bin=bitstream[40:160])
-        self._attrs["spare"]      = bitstring.Bits(bin=bitstream[160:168])
-        
 
 class AISStaticDataReportBMessage(AISMessage):
+    FIELDS = (
+        ('id', 'uint', 6),
+        ('repeat', 'uint', 2),
+        ('mmsi', 'uint', 30),
+        ('partno', 'uint', 2),
+        ('shiptype', 'uint', 8),
+        ('vendorid', 'uint', 18),
+        ('model', 'uint', 4),
+        ('serial', 'uint', 20),
+        ('callsign', 'uint', 42),
+        ('to_bow', 'uint', 9),
+        ('to_stern', 'uint', 9),
+        ('to_port', 'uint', 6),
+        ('to_starboard', 'uint', 6),
+        ('spare', 'uint', 6),
+    )
+
     def __init__(self, id=24, repeat=0, mmsi=0, partno=1, shiptype=0,
                        vendorid=0,model=0,serial=0,callsign=0,
                        to_bow=0,to_stern=0,to_port=0,to_starboard=0,
@@ -365,58 +532,100 @@ class AISStaticDataReportBMessage(AISMessage):
         """
         
         super(AISStaticDataReportBMessage, self).__init__({
-                    # message_element : ["data_type", num_bits, initial_value]
-                    'id'              : ["uint", 6, id], 
-                    'repeat'          : ["uint", 2, repeat], 
-                    'mmsi'            : ["uint", 30, mmsi], 
-                    'partno'          : ["uint", 2, partno], 
-                    'shiptype'        : ["uint", 8, shiptype], 
-                    'vendorid'        : ["uint", 18, AISString2Bits(vendorid,length=18/6).int if type(vendorid) == str else vendorid], 
-                    'model'           : ["uint", 4, model], 
-                    'serial'          : ["uint", 20, serial], 
-                    'callsign'        : ["uint", 42, AISString2Bits(callsign,length=42/6).int if type(callsign) == str else callsign], 
-                    'to_bow'          : ["uint", 9, to_bow], 
-                    'to_stern'        : ["uint", 9, to_stern], 
-                    'to_port'         : ["uint", 6, to_port], 
-                    'to_starboard'    : ["uint", 6, to_starboard], 
-                    'spare'           : ["uint", 6, spare]
+                    'id'              : id, 
+                    'repeat'          : repeat, 
+                    'mmsi'            : mmsi, 
+                    'partno'          : partno, 
+                    'shiptype'        : shiptype, 
+                    'vendorid'        : AISString2Int(vendorid, 18 // 6) if type(vendorid) == str else vendorid, 
+                    'model'           : model, 
+                    'serial'          : serial, 
+                    'callsign'        : AISString2Int(callsign, 42 // 6) if type(callsign) == str else callsign, 
+                    'to_bow'          : to_bow, 
+                    'to_stern'        : to_stern, 
+                    'to_port'         : to_port, 
+                    'to_starboard'    : to_starboard, 
+                    'spare'           : spare
                 })
-    
-    def build_bitstream(self):
-        return bitstring.Bits().join([
-            self.id,
-            self.repeat,
-            self.mmsi,
-            self.partno,
-            self.shiptype,
-            self.vendorid,
-            self.model,
-            self.serial,
-            self.callsign,
-            self.to_bow,
-            self.to_stern,
-            self.to_port,
-            self.to_starboard,
-            self.spare
-        ])
-    
-    def unpack(self, bitstream):
-        # TODO: figure out a better way to do this, but works fine for now
-        self._attrs["id"]       = bitstring.Bits(bin=bitstream[0:6])
-        self._attrs["repeat"]   = bitstring.Bits(bin=bitstream[6:8])
-        self._attrs["mmsi"]     = bitstring.Bits(bin=bitstream[8:38])
-        self._attrs["partno"]   = bitstring.Bits(bin=bitstream[38:40])
-        self._attrs["shiptype"] = bitstring.Bits(bin=bitstream[40:48])
-        self._attrs["vendorid"] = bitstring.Bits(bin=bitstream[48:66])
-        self._attrs["model"]    = bitstring.Bits(bin=bitstream[66:70])
-        self._attrs["serial"]   = bitstring.Bits(bin=bitstream[70:90])
-        self._attrs["callsign"] = bitstring.Bits(bin=bitstream[90:132])
-        self._attrs["to_bow"]   = bitstring.Bits(bin=bitstream[132:141])
-        self._attrs["to_stern"] = bitstring.Bits(bin=bitstream[141:150])
-        self._attrs["to_port"]  = bitstring.Bits(bin=bitstream[150:156])
-        self._attrs["to_starboard"]  = bitstring.Bits(bin=bitstream[156:162])
-        self._attrs["spare"]      = bitstring.Bits(bin=bitstream[162:168])
-        
+
+class AISMessageView(object):
+    """
+    Lazy view of an armored AIS payload, for routing and filtering.
+
+    The message type (id), repeat indicator and MMSI, in the first 7
+    characters, are decoded when the view is made. Any other field is
+    decoded from just the characters that hold it when it is first read,
+    and kept. A view reads like an AISMessage, e.g. view.sog or
+    view.get_attr('sog'), and message() decodes all of it.
+    """
+
+    __slots__ = ('payload', 'fillbits', 'id', 'repeat', 'mmsi', '_partno', '_values')
+
+    def __init__(self, payload, fillbits=0):
+        """
+        Raises ValueError if the payload is too short to hold the header or
+        is badly armored
+        """
+
+        if len(payload) < 7:
+            raise ValueError("AIS payload too short.")
+        header = payload_bits(payload, 0, 42)
+        self.payload = payload
+        self.fillbits = fillbits
+        self.id = header >> 36
+        self.repeat = (header >> 34) & 3
+        self.mmsi = (header >> 4) & 0x3fffffff
+        # bits 38 and 39, the part number of type 24
+        self._partno = (header >> 2) & 3
+        self._values = None
+
+    def message_class(self):
+        return message_class(self.id, self._partno)
+
+    def get_attr(self, name):
+        """
+        Returns the integer value of the given element name, or None if the
+        message has no such element
+        """
+
+        values = self._values
+        if values is None:
+            values = self._values = {'id': self.id, 'repeat': self.repeat, 'mmsi': self.mmsi}
+        if name in values:
+            return values[name]
+        cls = self.message_class()
+        if cls is None or name not in cls._offsets:
+            return values.get(name)
+        offset, bits, signed = cls._offsets[name]
+        value = payload_bits(self.payload, offset, bits)
+        if signed and value >> (bits - 1):
+            value -= 1 << bits
+        values[name] = value
+        return value
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        value = self.get_attr(name)
+        if value is None:
+            raise AttributeError(name)
+        return value
+
+    def position(self):
+        """
+        Returns (latitude, longitude) in degrees from a position report,
+        or None if there is none
+        """
+
+        return payload_position(self.payload, self.id)
+
+    def message(self):
+        """
+        Returns the whole message, as decode_payload does
+        """
+
+        return decode_payload(self.payload, self.fillbits)
+
 class AIS(object):
     # Instance of the AISMessage class
     _ais_message = None
@@ -433,7 +642,8 @@ class AIS(object):
         """
         Builds the AIS NMEA message string
         This method only supports AIVDM, single fragment, 168 bit (28-char) payload
-        Type 1 and Type 24 format A are of this kind
+        Type 1 and Type 24 format A are of this kind. build_sentences splits
+        longer messages, such as type 5, into fragments
         
         Field 1, !AIVDM, identifies this as an AIVDM packet.
 
@@ -466,37 +676,37 @@ class AIS(object):
 
         return payload + "%02X" % (chksum & 0xff)
         
-    def encode(self, bitstr = None):
+    def build_sentences(self, seqid = 0, channel = 'A', invert_crc = False):
         """
-        Encode a bitstream into a 6-bit encoded AIS message string
+        Builds the AIS NMEA sentences for the message, as many fragments as
+        are needed to keep each sentence within the 82 character limit. A
+        message that fits one sentence is built just as build_payload builds
+        it; the fragments of a longer one carry the sequential message ID
+        seqid (0-9).
         
-        @param  bitstr  The bitstream. This should be a Bit object generated 
-                        from bitstring.Bit(...). If this is not provided, then
-                        it will use the bitstring from the '_ais_message' property
-        @return         6-bit encoded AIS string
+        @return         List of sentences, without line endings
         """
         
-        curr_index = 0
-        curr_offset = 6     # We'll be encoding 6 bits at a time
-        encoded_str = []
+        payload, fillbits = self.encode().split(',')
+        return fragment_sentences(payload, int(fillbits), seqid, channel, invert_crc)
         
-        if bitstr == None:
-            bitstr = self._ais_message.build_bitstream()
+    def encode(self, bitstr = None):
+        """
+        Encode a bitstream into a 6-bit encoded AIS message string
         
-        # The total AIS message is len(bitstr) bits
-        # Since we are encoding 6-bit chunks, we are looping
-        #  round(len(bitstr)/ 6.) times (type 5 has 424 bits which does not divide by 6
-       #print len(bitstr),len(bitstr)/6,len(bitstr)/6.,int(round(len(bitstr)/6.))
-        for i in range(0, int(round(len(bitstr)/6.))):
-            block = bitstr[curr_index:curr_offset]
-            encoded_str.append(encodingchars[block.uint])
-            curr_index += 6
-            curr_offset += 6
-        remainingbits = len(bitstr) %6
-        fillbits = (6 -remainingbits) if remainingbits !=0 else 0
-
-        return ("".join(encoded_str))+','+chr(ord('0')+fillbits)
-    def decode(self, msg):
+        @param  bitstr  The bitstream, a bitstring.Bits. If this is not
+                        provided, then the '_ais_message' property is packed
+        @return         6-bit encoded AIS string and the fill bits, "payload,fill"
+        """
+        
+        if bitstr is None:
+            bits, length = self._ais_message.pack(), self._ais_message.length
+        else:
+            bits, length = bitstr.uint, len(bitstr)
+        payload, fillbits = armor(bits, length)
+        return "%s,%d" % (payload, fillbits)
+
+    def decode(self, msg, lazy = False):
         """
         Decodes an AIS NMEA formatted message. Currently only supports the 
         Position Report Message type. On success, returns an instance of 
@@ -504,6 +714,8 @@ class AIS(object):
         match, a CRCInvalidError exception is thrown
         
         @param  msg     The message to decode
+        @param  lazy    Return an AISMessageView, which decodes only the
+                        type and MMSI until other fields are read
         @return         If CRC checks, returns an instance of AISPositionReportMessage
         """
         
@@ -519,33 +731,9 @@ class AIS(object):
         
         # Grap just the payload. The 6th index in the AIS message contains the payload
         payload,fillbits = msg.split(",")[5:7]
-        
-        # First we will reverse the 6-bit ascii encoding to its integer equivalent
-        # using our reverse encoded character map
-        dec = []
-        
-        for c in payload:
-            dec.append(re_encodingchars[c])
-        
-        # Now we will take our list of integers and convert it to a bitstream
-        bits = []
-        
-        for i in range(len(dec)):
-            bits.append(int2bin6(dec[i]))
-            
-        bitstream = "".join(bits)
-        if fillbits[0] !='0':bitstream = bitstream[:-int(fillbits[0])]
-        msgId = bitstream[0:6]#;print msgId
-        if   msgId == '000001':
-             aismsg = AISPositionReportMessage()
-        elif msgId == '011000' and bitstream[38] == '0':
-             aismsg = AISStaticDataReportAMessage()
-        elif msgId == '011000' and bitstream[38] == '1':
-             aismsg = AISStaticDataReportBMessage()
-        elif msgId == '000101':
-             aismsg = AISStaticAndVoyageReportMessage()
-        aismsg.unpack(bitstream)
-        return aismsg
+        if lazy:
+            return AISMessageView(payload, int(fillbits[0]))
+        return decode_payload(payload, int(fillbits[0]))
     
     def crc(self, msg):
         """
@@ -557,8 +745,6 @@ class AIS(object):
                         to get the hex
         """
         
-        chksum = 0
-        
         # If the input contains the entire NMEA message, then we just need to
         # get the string between the ! and *
         # Otherwise we'll assume the input contains just the string to checksum
@@ -567,8 +753,388 @@ class AIS(object):
         if msg[0] == "!" and astk != -1:
             msg = msg[1:astk]
         
-        for c in msg:
-            chksum = chksum ^ ord(c)
-            
-        return chksum
+        return nmea_checksum(msg)
+
+# Payload characters in each fragment of a multi-sentence message, which
+# keeps the sentences within the 82 characters of NMEA 0183
+FRAGMENT_CHARS = 60
+
+def fragment_sentences(payload, fillbits, seqid=0, channel='A', invert_crc=False, talker='AIVDM'):
+    """
+    Splits an armored payload into numbered AIVDM sentences. Only the
+    last fragment has fill bits. Returns a list of sentences.
+    """
+
+    count = max(1, (len(payload) + FRAGMENT_CHARS - 1) // FRAGMENT_CHARS)
+    seqid = str(seqid) if count > 1 else ''
+    sentences = []
+    for number in range(1, count + 1):
+        part = payload[(number - 1) * FRAGMENT_CHARS:number * FRAGMENT_CHARS]
+        body = "%s,%d,%d,%s,%s,%s,%d" % (talker, count, number, seqid, channel, part,
+                                         fillbits if number == count else 0)
+        chksum = nmea_checksum(body)
+        if invert_crc:
+            chksum = ~chksum
+        sentences.append("!%s*%02X" % (body, chksum & 0xff))
+    return sentences
+
+class AISStream(object):
+    """
+    Streaming AIVDM/AIVDO codec, for use as a stage over a live feed.
+
+    decode() takes sentences as they arrive and yields the messages they
+    hold, putting multi-sentence messages back together by talker,
+    sequential message ID and channel. The fragments of a message are
+    kept waiting for the rest of it for at most timeout seconds, and no
+    more than max_pending messages wait at once, the oldest being
+    dropped first.
+
+    encode() takes AISMessages and yields their sentences, numbering
+    multi-sentence messages with the sequential message IDs 0-9 in turn.
+    """
+
+    def __init__(self, timeout=10.0, max_pending=64, channel='A'):
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.channel = channel
+        # (talker, seqid, channel) : [time of first fragment, fragment count, payloads],
+        # oldest first
+        self.pending = collections.OrderedDict()
+        self.next_seqid = 0
+        self.decoded = 0
+        self.errors = 0
+        self.unsupported = 0
+        self.evicted = 0
+
+    def expire(self, now):
+        """
+        Drop the messages that have waited too long, or the oldest while
+        too many are waiting
+        """
+
+        while self.pending:
+            key, parts = next(self.pending.iteritems())
+            if now - parts[0] <= self.timeout and len(self.pending) <= self.max_pending:
+                break
+            del self.pending[key]
+            self.evicted += 1
+
+    def feed(self, sentence, now=None):
+        """
+        Take one sentence. Returns the AISMessage if the sentence completes
+        one, otherwise None. Sentences with a bad checksum or payload, and
+        messages of types this library does not decode, are counted and
+        dropped rather than raising.
+        """
+
+        sentence = sentence.strip()
+        if sentence[:1] != '!' or sentence[3:6] not in ('VDM', 'VDO'):
+            return None
+        if now is None:
+            now = time.time()
+        star = sentence.rfind('*')
+        try:
+            if star < 0 or int(sentence[star + 1:star + 3], 16) != nmea_checksum(sentence[1:star]):
+                raise ValueError("Bad checksum")
+            fields = sentence[:star].split(',')
+            count, number, seqid, channel, payload, fillbits = fields[1:7]
+            count, number, fillbits = int(count or 1), int(number or 1), int(fillbits or 0)
+        except ValueError:
+            self.errors += 1
+            return None
+
+        if count > 1:
+            key = (fields[0], seqid, channel)
+            if number == 1:
+                # a new message replaces any unfinished one with the same ID
+                self.pending.pop(key, None)
+                self.pending[key] = [now, count, [payload]]
+                self.expire(now)
+                return None
+            parts = self.pending.get(key)
+            if parts is None:
+                # we missed the start, or it was dropped
+                self.errors += 1
+                return None
+            if parts[1] != count or len(parts[2]) + 1 != number or now - parts[0] > self.timeout:
+                del self.pending[key]
+                self.errors += 1
+                return None
+            parts[2].append(payload)
+            if number < count:
+                return None
+            del self.pending[key]
+            payload = "".join(parts[2])
+
+        try:
+            aismsg = decode_payload(payload, fillbits)
+        except ValueError:
+            self.errors += 1
+            return None
+        if aismsg is None:
+            self.unsupported += 1
+            return None
+        self.decoded += 1
+        return aismsg
+
+    def decode(self, lines):
+        """
+        Generate the AISMessages in an iterable of sentences, e.g. a file
+        or socket being read
+        """
+
+        for line in lines:
+            aismsg = self.feed(line)
+            if aismsg is not None:
+                yield aismsg
+
+    def encode(self, aismsgs):
+        """
+        Generate the sentences for an iterable of AISMessages
+        """
+
+        for aismsg in aismsgs:
+            sentences = AIS(aismsg).build_sentences(self.next_seqid, self.channel)
+            if len(sentences) > 1:
+                self.next_seqid = (self.next_seqid + 1) % 10
+            for sentence in sentences:
+                yield sentence
+
+    def __str__(self):
+        return "AIS stream: %d messages decoded, %d errors, %d unsupported, %d waiting, %d dropped unfinished" % \
+            (self.decoded, self.errors, self.unsupported, len(self.pending), self.evicted)
+
+# Batch decoding into NumPy arrays, for analysing recordings and logs.
+# NumPy is only imported when decode_batch is used.
+
+# Columns of the arrays from decode_batch. Positions are in degrees,
+# speeds in knots, courses and headings in degrees and the draught in
+# metres, NaN where not available or not sent by the message type;
+# the rest are the raw field values, 0 where not sent.
+BATCH_COLUMNS = [
+    ('line', 'i8'),
+    ('type', 'u1'),
+    ('repeat', 'u1'),
+    ('mmsi', 'u4'),
+    ('status', 'u1'),
+    ('rot', 'i1'),
+    ('sog', 'f4'),
+    ('pa', 'u1'),
+    ('lon', 'f8'),
+    ('lat', 'f8'),
+    ('cog', 'f4'),
+    ('heading', 'f4'),
+    ('ts', 'u1'),
+    ('partno', 'u1'),
+    ('imo', 'u4'),
+    ('callsign', 'S7'),
+    ('shipname', 'S20'),
+    ('shiptype', 'u1'),
+    ('to_bow', 'u2'),
+    ('to_stern', 'u2'),
+    ('to_port', 'u1'),
+    ('to_starboard', 'u1'),
+    ('draught', 'f4'),
+    ('destination', 'S20'),
+]
+
+# column : (raw value meaning not available, scale)
+BATCH_SCALED = {
+    'lat': (91 * 600000, 600000.0),
+    'lon': (181 * 600000, 600000.0),
+    'sog': (1023, 10.0),
+    'cog': (3600, 10.0),
+    'heading': (511, 1.0),
+    'draught': (None, 10.0),
+}
+
+# armored character to its 6 bit value, anything else to 255
+_six_bits = ['\xff'] * 256
+for i, c in enumerate(encodingchars):
+    _six_bits[ord(c)] = chr(i)
+_six_bits = "".join(_six_bits)
+
+def _batch_messages(lines):
+    """
+    Picks the AIVDM and AIVDO sentences from lines and joins the fragments
+    of multi-sentence messages. Returns, for each complete message, the
+    index of its first line and its payload, and for each sentence used
+    the message it belongs to.
+    """
+
+    first_lines = []
+    payloads = []
+    sentences = []
+    owners = []
+    # (talker, seqid, channel) : [first line, payloads, sentences]
+    pending = {}
+    for i, line in enumerate(lines):
+        if line[:1] != '!' or line[3:6] not in ('VDM', 'VDO'):
+            continue
+        line = line.rstrip()
+        fields = line.split(',', 6)
+        if len(fields) < 7:
+            fields.extend([''] * (7 - len(fields)))
+        count, number, seqid, channel, payload = fields[1:6]
+        if count == '1' or count == '':
+            # the usual single sentence message
+            owners.append(len(payloads))
+            sentences.append(line)
+            first_lines.append(i)
+            payloads.append(payload)
+            continue
+        key = (fields[0], seqid, channel)
+        if number == '1':
+            pending[key] = [i, [payload], [line]]
+            continue
+        parts = pending.get(key)
+        if parts is None:
+            continue
+        parts[1].append(payload)
+        parts[2].append(line)
+        if number != count:
+            continue
+        del pending[key]
+        for sentence in parts[2]:
+            owners.append(len(payloads))
+            sentences.append(sentence)
+        first_lines.append(parts[0])
+        payloads.append("".join(parts[1]))
+    return first_lines, payloads, sentences, owners
+
+# hexadecimal digit to its value, anything else to 255
+_hex_digits = ['\xff'] * 256
+for i, c in enumerate('0123456789ABCDEF'):
+    _hex_digits[ord(c)] = _hex_digits[ord(c.lower())] = chr(i)
+_hex_digits = "".join(_hex_digits)
+
+def _batch_checksums(numpy, sentences):
+    """
+    True for each sentence that ends *hh with a matching checksum
+    """
+
+    count = len(sentences)
+    if not count:
+        return numpy.zeros(0, bool)
+    lengths = numpy.array([len(sentence) for sentence in sentences])
+    width = max(lengths.max(), 4)
+    # NUL padding leaves the XOR unchanged
+    data = numpy.frombuffer("".join([sentence.ljust(width, '\0') for sentence in sentences]), numpy.uint8)
+    data = data.reshape(count, width)
+    rows = numpy.arange(count)
+    star = numpy.maximum(lengths - 3, 0)
+    columns = numpy.arange(width)
+    body = (columns >= 1) & (columns < star[:, None])
+    computed = numpy.bitwise_xor.reduce(numpy.where(body, data, 0), axis=1)
+    digits = numpy.frombuffer(_hex_digits, numpy.uint8)
+    high = digits[data[rows, numpy.minimum(star + 1, width - 1)]]
+    low = digits[data[rows, numpy.minimum(star + 2, width - 1)]]
+    return (lengths >= 4) & (data[rows, star] == ord('*')) & (high < 16) & (low < 16) & \
+        (computed == high * 16 + low)
+
+def _batch_fields(numpy, cls, payloads, columns):
+    """
+    Decodes armored payloads all of message class cls, returning
+    {column: array of values} for the columns the class has, and a mask
+    of the payloads holding characters that are not armored
+    """
+
+    chars = (cls.length + 5) // 6
+    # short payloads are padded with zeros, like decode_payload does
+    text = "".join([payload[:chars].ljust(chars, '0') for payload in payloads])
+    values = numpy.frombuffer(text.translate(_six_bits), numpy.uint8).reshape(len(payloads), chars)
+    garbled = (values == 255).any(axis=1)
+    values = numpy.where(values == 255, 0, values).astype(numpy.uint8)
+    # one row of bits per message
+    bits = numpy.unpackbits(values[:, :, None], axis=2)[:, :, 2:].reshape(len(payloads), chars * 6)
+
+    found = {}
+    offset = 0
+    for name, kind, size in cls.FIELDS:
+        column = 'type' if name == 'id' else name
+        if column in columns:
+            field = bits[:, offset:offset + size]
+            if columns[column].startswith('S'):
+                # text, 6 bits a character
+                codes = field.reshape(len(payloads), size // 6, 6).dot(1 << numpy.arange(5, -1, -1))
+                text = numpy.frombuffer(AISchars, 'S1')[codes].view('S%d' % (size // 6)).ravel()
+                found[column] = numpy.char.rstrip(text, '@ ')
+            else:
+                value = field.dot(1 << numpy.arange(size - 1, -1, -1, dtype=numpy.int64))
+                if kind == 'int':
+                    value = numpy.where(value >> (size - 1), value - (1 << size), value)
+                found[column] = value
+        offset += size
+    return found, garbled
+
+def decode_batch(lines, chunk=65536):
+    """
+    Decodes many AIS sentences at once into a NumPy structured array, with
+    the columns in BATCH_COLUMNS and one row for each complete message.
+
+    lines is a list or other iterable of sentences, an open file, or a
+    string holding many lines. Sentences other than AIVDM and AIVDO are
+    skipped, and multi-sentence messages are put back together. The
+    line column is the index in lines of the first sentence of each
+    message, e.g. to find its time in a recording.
+
+    Rather than raising, messages with a bad checksum or payload, or of a
+    type this library does not decode, are masked: the result is a
+    numpy.ma.MaskedArray with every column of those rows masked.
+
+    Payloads are de-armored and their fields extracted chunk messages at
+    a time, with array operations over all the messages of each type.
+    """
+
+    import numpy
+
+    if isinstance(lines, basestring):
+        lines = lines.splitlines()
+    first_lines, payloads, sentences, owners = _batch_messages(lines)
+    count = len(payloads)
+    columns = dict(BATCH_COLUMNS)
+
+    result = numpy.zeros(count, dtype=BATCH_COLUMNS)
+    for name, dtype in BATCH_COLUMNS:
+        if dtype.startswith('f'):
+            result[name] = numpy.nan
+    result['line'] = first_lines
+
+    valid = numpy.ones(count, bool)
+    bad = ~_batch_checksums(numpy, sentences)
+    if bad.any():
+        valid[numpy.array(owners)[bad]] = False
+
+    # sort the messages by class, from the type and the part number of
+    # type 24 in the first 7 characters
+    heads = "".join([payload[:7].ljust(7, '\xff') for payload in payloads]).translate(_six_bits)
+    heads = numpy.frombuffer(heads, numpy.uint8).reshape(count, 7)
+    types = heads[:, 0]
+    partno = numpy.where(heads[:, 6] == 255, 255, (heads[:, 6] >> 2) & 3)
+    kinds = {
+        AISPositionReportMessage: (types == 1) | (types == 2) | (types == 3),
+        AISStaticAndVoyageReportMessage: types == 5,
+        AISStaticDataReportAMessage: (types == 24) & (partno == 0),
+        AISStaticDataReportBMessage: (types == 24) & (partno == 1),
+    }
+    supported = numpy.zeros(count, bool)
+    for cls, rows in kinds.items():
+        supported |= rows
+        kinds[cls] = numpy.flatnonzero(rows)
+    valid &= supported
+
+    for cls, rows in kinds.items():
+        for start in range(0, len(rows), chunk):
+            index = rows[start:start + chunk]
+            found, garbled = _batch_fields(numpy, cls, [payloads[i] for i in index], columns)
+            for name, values in found.items():
+                result[name][index] = values
+            valid[index[garbled]] = False
+
+    for name, (missing, scale) in BATCH_SCALED.items():
+        values = result[name]
+        if missing is not None:
+            values[values == missing] = numpy.nan
+        values /= scale
 
+    return numpy.ma.masked_array(result, mask=~valid)
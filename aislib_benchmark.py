@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+"""
+Encode and decode benchmark for aislib.
+
+Times building the sentence for, and decoding, each supported kind of AIS
+message, and decoding just the type and MMSI through a lazy AISMessageView,
+and prints microseconds per message and messages per second.
+--module times another copy of the library instead, e.g. the aislib.py
+from before the commit that compiled the field tables, to compare against:
+
+    ./aislib_benchmark.py
+    git show $(git log -1 --format=%h --grep='Compile the AIS field tables')~1:aislib.py > /tmp/old_aislib.py
+    ./aislib_benchmark.py --module /tmp/old_aislib.py
+"""
+
+import argparse
+import imp
+import json
+import os
+import random
+import sys
+import timeit
+
+
+def messages(aislib, count):
+    """
+    count random messages of each kind, as (name, [AISMessage]). Kinds
+    the library cannot build are left out.
+    """
+
+    rnd = random.Random(1)
+    kinds = [
+        ('position (1)', lambda: aislib.AISPositionReportMessage(
+            mmsi=rnd.randint(200000000, 799999999), status=rnd.randint(0, 15), rot=rnd.randint(-127, 127),
+            sog=rnd.randint(0, 1022), lon=rnd.randint(-108000000, 108000000), lat=rnd.randint(-54000000, 54000000),
+            cog=rnd.randint(0, 3599), heading=rnd.randint(0, 359), ts=rnd.randint(0, 59),
+            comm_state=rnd.randint(0, 2 ** 19 - 1))),
+        ('static and voyage (5)', lambda: aislib.AISStaticAndVoyageReportMessage(
+            mmsi=rnd.randint(200000000, 799999999), imo=rnd.randint(0, 9999999), callsign='VJN%04d' % rnd.randint(0, 9999),
+            shipname='VESSEL %d' % rnd.randint(0, 99999), shiptype=rnd.randint(0, 99), to_bow=rnd.randint(0, 300),
+            draught=rnd.randint(0, 255), destination='SYDNEY')),
+        ('static A (24)', lambda: aislib.AISStaticDataReportAMessage(
+            mmsi=rnd.randint(200000000, 799999999), shipname='VESSEL %d' % rnd.randint(0, 99999))),
+        ('static B (24)', lambda: aislib.AISStaticDataReportBMessage(
+            mmsi=rnd.randint(200000000, 799999999), shiptype=rnd.randint(0, 99), serial=rnd.randint(0, 2 ** 20 - 1),
+            callsign='VJN%04d' % rnd.randint(0, 9999), to_bow=rnd.randint(0, 300))),
+    ]
+    built = []
+    for name, make in kinds:
+        try:
+            built.append((name, [make() for i in range(count)]))
+        except (TypeError, ValueError) as e:
+            print >>sys.stderr, "Cannot build %s messages: %s" % (name, e)
+    return built
+
+
+def best(function, repeat):
+    """
+    Seconds for the fastest of repeat runs of function
+    """
+
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def run(aislib, count, repeat):
+    results = {}
+    for name, aismsgs in messages(aislib, count):
+        wrappers = [aislib.AIS(aismsg) for aismsg in aismsgs]
+        sentences = [wrapper.build_payload() for wrapper in wrappers]
+        decoder = wrappers[0]
+
+        def encode():
+            for wrapper in wrappers:
+                wrapper.build_payload()
+
+        def decode():
+            for sentence in sentences:
+                decoder.decode(sentence)
+
+        encode_time = best(encode, repeat) / count
+        decode_time = best(decode, repeat) / count
+        results[name] = {'encode_us': encode_time * 1e6, 'decode_us': decode_time * 1e6}
+        line = "%-22s encode %8.1fus (%7d/s)  decode %8.1fus (%7d/s)" % \
+            (name, encode_time * 1e6, 1 / encode_time, decode_time * 1e6, 1 / decode_time)
+
+        if hasattr(aislib, 'AISMessageView'):
+            payloads = [sentence.split(',')[5] for sentence in sentences]
+
+            def header():
+                # what routing by type and MMSI needs
+                for payload in payloads:
+                    view = aislib.AISMessageView(payload)
+                    view.id, view.mmsi
+
+            header_time = best(header, repeat) / count
+            results[name]['header_us'] = header_time * 1e6
+            line += "  header %6.1fus (%7d/s)" % (header_time * 1e6, 1 / header_time)
+        print line
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Time AIS message encoding and decoding')
+    parser.add_argument('-n', '--count', default=1000, type=int, help='messages of each kind per run')
+    parser.add_argument('-r', '--repeat', default=5, type=int, help='runs, the fastest is reported')
+    parser.add_argument('-m', '--module', help='aislib.py to time, by default the one beside this script')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    if args.module:
+        aislib = imp.load_source('aislib_under_test', args.module)
+    else:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import aislib
+
+    results = run(aislib, args.count, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
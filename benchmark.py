@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+
+"""
+Load and latency benchmark for server.py.
+
+Starts the server on a private FIFO, feeds it a realistic mix of NMEA and
+AIS sentences at a steady rate and connects a number of TCP clients, some
+of which read slowly on purpose. Every tenth sentence is a timing sentence
+
+    $PBNCH,<sequence>,<time written>*hh
+
+so each client can measure how long sentences take to get through the
+server. At the end throughput, fan-out latency percentiles and the
+server's CPU time and memory are printed and written as JSON, e.g.
+
+    ./benchmark.py --rate 500 --clients 20 --slow 2 --duration 30 -o bench.json
+    ./benchmark.py --rate 2000 --clients 100 --server-args="--workers 4"
+"""
+
+import argparse
+import errno
+import json
+import os
+import random
+import select
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aislib
+
+
+def checksum(body):
+    value = 0
+    for c in body:
+        value ^= ord(c)
+    return value
+
+
+def sentence(start, body):
+    return '%s%s*%02X\r\n' % (start, body, checksum(body))
+
+
+def ais_sentences(vessels=6, seed=1):
+    """
+    AIS sentences from a fleet of vessels around Sydney Harbour, each with
+    its own MMSI: a position report from every vessel, static and voyage
+    data (two sentences) from the first and both parts of the class B
+    static data from the second
+    """
+
+    rnd = random.Random(seed)
+    messages = []
+    for i in range(vessels):
+        mmsi = 503000000 + rnd.randint(0, 999999)
+        messages.append(aislib.AISPositionReportMessage(
+            mmsi=mmsi, status=rnd.choice((0, 5, 8)), sog=rnd.randint(0, 200), rot=0,
+            lon=int(rnd.uniform(151.18, 151.29) * 600000), lat=int(rnd.uniform(-33.87, -33.83) * 600000),
+            cog=rnd.randint(0, 3599), heading=rnd.randint(0, 359), ts=rnd.randint(0, 59)))
+        if i == 0:
+            messages.append(aislib.AISStaticAndVoyageReportMessage(
+                mmsi=mmsi, imo=9000000 + rnd.randint(0, 999999), callsign='VJN%04d' % rnd.randint(0, 9999),
+                shipname='SIRIUS STAR', shiptype=70, to_bow=120, to_stern=30, to_port=12, to_starboard=12,
+                draught=85, destination='SYDNEY'))
+        elif i == 1:
+            messages.append(aislib.AISStaticDataReportAMessage(mmsi=mmsi, shipname='WAIMEA'))
+            messages.append(aislib.AISStaticDataReportBMessage(mmsi=mmsi, shiptype=37, callsign='VHW%04d' %
+                                                               rnd.randint(0, 9999), to_bow=8, to_stern=4))
+    sentences = []
+    for n, message in enumerate(messages):
+        sentences.extend(line + '\r\n' for line in
+                         aislib.AIS(message).build_sentences(seqid=n % 10, channel='AB'[n % 2]))
+    return sentences
+
+
+# A typical feed: GPS, wind, depth, heading and AIS
+SAMPLE_SENTENCES = [
+    sentence('$', 'GPRMC,201515,A,3517.602,S,14906.945,E,006.1,054.7,140519,011.6,E'),
+    sentence('$', 'GPGGA,201515,3517.602,S,14906.945,E,1,08,0.9,575.4,M,21.5,M,,'),
+    sentence('$', 'IIMWV,045.0,R,12.6,N,A'),
+    sentence('$', 'SDDPT,3.6,0.0'),
+    sentence('$', 'HEHDT,054.7,T'),
+] + ais_sentences()
+
+TIMING_EVERY = 10
+
+
+def timing_sentence(seq, now):
+    return sentence('$', 'PBNCH,%d,%.6f' % (seq, now))
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[k]
+
+
+def process_usage(pid):
+    """
+    CPU seconds and peak resident memory (kB) of a process and its children
+    """
+
+    ticks = os.sysconf(os.sysconf_names['SC_CLK_TCK'])
+    pids = [pid]
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open('/proc/%s/stat' % entry) as f:
+                    if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                        pids.append(int(entry))
+            except (IOError, IndexError, ValueError):
+                pass
+    cpu = 0.0
+    rss = 0
+    for p in pids:
+        try:
+            with open('/proc/%d/stat' % p) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / float(ticks)
+            with open('/proc/%d/status' % p) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        rss += int(line.split()[1])
+        except IOError:
+            pass
+    return cpu, rss
+
+
+class BenchClient(object):
+    """
+    Simulated TCP client. A slow client reads only a little, once a second.
+    """
+
+    def __init__(self, port, slow=False):
+        self.slow = slow
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        if slow:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        self.sock.setblocking(0)
+        self.partial = ''
+        self.sentences = 0
+        self.bytes = 0
+        self.latencies = []
+        self.next_read = 0.0
+        self.closed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def wants_read(self, now):
+        return not self.closed and (not self.slow or now >= self.next_read)
+
+    def read(self, now):
+        try:
+            data = self.sock.recv(512 if self.slow else 65536)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.closed = True
+            return
+        if not data:
+            self.closed = True
+            return
+        if self.slow:
+            self.next_read = now + 1.0
+        self.bytes += len(data)
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        self.sentences += len(lines)
+        for line in lines:
+            if line.startswith('$PBNCH,'):
+                try:
+                    self.latencies.append(now - float(line.split(',')[2].split('*')[0]))
+                except (IndexError, ValueError):
+                    pass
+
+
+def summarise(clients):
+    latencies = []
+    for client in clients:
+        latencies.extend(client.latencies)
+    result = {
+        'clients': len(clients),
+        'sentences': sum(client.sentences for client in clients),
+        'bytes': sum(client.bytes for client in clients),
+        'disconnected': sum(1 for client in clients if client.closed),
+        'latency_samples': len(latencies),
+    }
+    for name, p in (('p50', 50), ('p99', 99), ('max', 100)):
+        value = percentile(latencies, p)
+        result['latency_%s_ms' % name] = None if value is None else round(value * 1000.0, 3)
+    return result
+
+
+def run(args):
+    directory = tempfile.mkdtemp(prefix='nmea_bench')
+    fifo_path = os.path.join(directory, 'nmea_fifo')
+    os.mkfifo(fifo_path)
+    command = [sys.executable, args.server, '--fifo', fifo_path, '--port', str(args.port)] + \
+        shlex.split(args.server_args)
+    server = subprocess.Popen(command, stderr=open(os.devnull, 'w'))
+    fifo = open(fifo_path, 'w')
+    time.sleep(args.settle)
+
+    clients = [BenchClient(args.port, slow=(i < args.slow)) for i in range(args.clients)]
+    time.sleep(args.settle)
+
+    interval = 0.01
+    sentences_per_tick = args.rate * interval
+    owed = 0.0
+    seq = 0
+    # multi-sentence AIS messages are kept whole by counting the samples
+    # apart from the timing sentences
+    sample = 0
+    written = 0
+    started = time.time()
+    cpu_start, rss = process_usage(server.pid)
+    next_tick = started
+    end = started + args.duration
+    while True:
+        now = time.time()
+        if now >= end:
+            break
+        if now >= next_tick:
+            owed += sentences_per_tick
+            batch = []
+            while owed >= 1.0:
+                if seq % TIMING_EVERY == 0:
+                    batch.append(timing_sentence(seq, time.time()))
+                else:
+                    batch.append(SAMPLE_SENTENCES[sample % len(SAMPLE_SENTENCES)])
+                    sample += 1
+                seq += 1
+                owed -= 1.0
+            if batch:
+                fifo.write(''.join(batch))
+                fifo.flush()
+                written += len(batch)
+            next_tick += interval
+        reading = [client for client in clients if client.wants_read(now)]
+        timeout = max(0.0, min(next_tick, end) - time.time())
+        if reading:
+            readable, _, _ = select.select(reading, [], [], timeout)
+        else:
+            readable = []
+            time.sleep(timeout)
+        now = time.time()
+        for client in readable:
+            client.read(now)
+
+    # let the fast clients catch up
+    drain_end = time.time() + args.settle
+    while time.time() < drain_end:
+        reading = [client for client in clients if not client.slow and not client.closed]
+        if not reading:
+            break
+        readable, _, _ = select.select(reading, [], [], 0.05)
+        now = time.time()
+        for client in readable:
+            client.read(now)
+    elapsed = time.time() - started
+
+    cpu_end, rss = process_usage(server.pid)
+    fifo.close()
+    server.terminate()
+    server.wait()
+    os.unlink(fifo_path)
+    os.rmdir(directory)
+
+    fast = [client for client in clients if not client.slow]
+    slow = [client for client in clients if client.slow]
+    result = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(started)),
+        'command': command,
+        'rate': args.rate,
+        'duration': args.duration,
+        'sentences_written': written,
+        'throughput_per_client': round(summarise(fast)['sentences'] / float(max(1, len(fast))) / elapsed, 1),
+        'server_cpu_seconds': round(cpu_end - cpu_start, 3),
+        'server_cpu_percent': round(100.0 * (cpu_end - cpu_start) / elapsed, 1),
+        'server_peak_rss_kb': rss,
+        'fast_clients': summarise(fast),
+        'slow_clients': summarise(slow),
+    }
+    return result
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Load and latency benchmark for server.py')
+    parser.add_argument('--server', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py'),
+                        help='server program to run')
+    parser.add_argument('--server-args', default='', help='extra arguments for the server')
+    parser.add_argument('-p', '--port', default=10100, type=int, help='TCP port for the server')
+    parser.add_argument('-r', '--rate', default=200, type=float, help='sentences per second written to the FIFO')
+    parser.add_argument('-c', '--clients', default=10, type=int, help='number of TCP clients')
+    parser.add_argument('-s', '--slow', default=1, type=int, help='how many of the clients read slowly')
+    parser.add_argument('-d', '--duration', default=10.0, type=float, help='seconds to run for')
+    parser.add_argument('--settle', default=0.5, type=float, help='seconds allowed for start up and drain')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    result = run(args)
+    text = json.dumps(result, indent=2, sort_keys=True)
+    print text
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+
+"""
+Collision risk (CPA/TCPA) from the live AIS stream.
+
+With server.py --cpa <nm> every AIS position report that passes through
+the server updates a table of vessel positions, speeds and courses, and
+each update is checked against the vessels near it for the closest point
+of approach (CPA) and the time until it (TCPA). When two vessels will pass
+closer than the alarm distance within the alarm time an alarm sentence
+
+    $AIALR,201515.00,017,A,V,CPA 0.12NM IN 4.3MIN 503633800 TRILOGY/235000000 RUBY PRINCESS*hh
+
+goes out in the stream to every client, and is repeated while the risk
+lasts. Condition V in the same alarm number clears it.
+
+Vessels are kept in a grid of cells as wide as the search range, so each
+update is compared only with the vessels in the nine cells around it
+rather than with every vessel in the harbour.
+"""
+
+import math
+import time
+
+import aislib
+
+# AIS message types with class A position reports
+POSITION_TYPES = (1, 2, 3)
+
+# nautical miles per degree of latitude
+NM_PER_DEGREE = 60.0
+
+
+class Target(object):
+    """
+    The latest known position and movement of a vessel
+    """
+
+    __slots__ = ('mmsi', 'name', 'heard', 'time', 'lat', 'lon', 'sog', 'vx', 'vy', 'cell')
+
+    def __init__(self, mmsi):
+        self.mmsi = mmsi
+        self.name = ''
+        self.heard = None
+        # time of the last position report
+        self.time = None
+        self.lat = None
+        self.lon = None
+        # speed, and velocity east and north, in knots
+        self.sog = 0.0
+        self.vx = 0.0
+        self.vy = 0.0
+        self.cell = None
+
+    def set_velocity(self, sog, cog):
+        self.sog = sog
+        cog = math.radians(cog)
+        self.vx = sog * math.sin(cog)
+        self.vy = sog * math.cos(cog)
+
+    def label(self):
+        if self.name:
+            return "%d %s" % (self.mmsi, self.name)
+        return str(self.mmsi)
+
+
+def format_sentence(body):
+    return '$%s*%02X\r\n' % (body, aislib.nmea_checksum(body))
+
+
+class CPAMonitor(object):
+    """
+    Tracks the vessels in the AIS stream and raises alarms for pairs at
+    risk of collision.
+
+    distance    alarm when the CPA is less than this (nm)
+    tcpa        ... and will be reached within this many seconds
+    search      only vessels within this range (nm) are compared
+    min_speed   pairs of vessels both slower than this (knots) are ignored
+    repeat      seconds between repeats of an alarm
+    max_age     vessels not heard from for this long are forgotten
+    """
+
+    def __init__(self, distance=0.25, tcpa=600.0, search=4.0, min_speed=0.5, repeat=60.0, max_age=360.0):
+        self.distance = distance
+        self.tcpa = tcpa
+        self.search = search
+        self.min_speed = min_speed
+        self.repeat = repeat
+        self.max_age = max_age
+        # mmsi : Target
+        self.targets = {}
+        # (row, column) : set of mmsi
+        self.grid = {}
+        # (mmsi, mmsi) : [alarm number, time last sent]
+        self.alarms = {}
+        self.next_alarm = 1
+        # fragments of multi-sentence messages being collected,
+        # (address, seqid, channel) : [payloads]
+        self.fragments = {}
+        self.next_expiry = 0.0
+        self.decoded = 0
+        self.errors = 0
+        self.comparisons = 0
+        self.raised = 0
+
+    def cell(self, lat, lon, row=None):
+        """
+        Grid cell of a position. Cells are search nm high and, measured at
+        the latitude of their row, search nm wide.
+        """
+
+        if row is None:
+            row = int(math.floor(lat * NM_PER_DEGREE / self.search))
+        scale = math.cos(math.radians((row + 0.5) * self.search / NM_PER_DEGREE))
+        column = int(math.floor(lon * NM_PER_DEGREE * max(scale, 0.01) / self.search))
+        return row, column
+
+    def neighbours(self, target):
+        row = target.cell[0]
+        for r in (row - 1, row, row + 1):
+            column = self.cell(target.lat, target.lon, r)[1]
+            for c in (column - 1, column, column + 1):
+                for mmsi in self.grid.get((r, c), ()):
+                    if mmsi != target.mmsi:
+                        yield self.targets[mmsi]
+
+    def move(self, target, lat, lon):
+        cell = self.cell(lat, lon)
+        if cell != target.cell:
+            if target.cell is not None:
+                self.remove_from_grid(target)
+            self.grid.setdefault(cell, set()).add(target.mmsi)
+            target.cell = cell
+        target.lat = lat
+        target.lon = lon
+
+    def remove_from_grid(self, target):
+        members = self.grid[target.cell]
+        members.discard(target.mmsi)
+        if not members:
+            del self.grid[target.cell]
+
+    def approach(self, a, b, now, scale):
+        """
+        Return (CPA in nm, TCPA in seconds) of two targets, each dead
+        reckoned to now. scale is nm per degree of longitude where they are.
+        """
+
+        # position of b relative to a, in nm, and its relative velocity in knots
+        dx = (b.lon - a.lon) * scale + (b.vx * (now - b.time) - a.vx * (now - a.time)) / 3600.0
+        dy = (b.lat - a.lat) * NM_PER_DEGREE + (b.vy * (now - b.time) - a.vy * (now - a.time)) / 3600.0
+        vx = b.vx - a.vx
+        vy = b.vy - a.vy
+        speed2 = vx * vx + vy * vy
+        if speed2 < 1e-6:
+            return math.hypot(dx, dy), 0.0
+        hours = -(dx * vx + dy * vy) / speed2
+        return math.hypot(dx + vx * hours, dy + vy * hours), hours * 3600.0
+
+    def alarm(self, pair, condition, cpa, tcpa, now):
+        a, b = self.targets[pair[0]], self.targets[pair[1]]
+        state = self.alarms.get(pair)
+        if state is None:
+            state = self.alarms[pair] = [self.next_alarm, None]
+            self.next_alarm = self.next_alarm % 999 + 1
+        state[1] = now
+        if condition == 'A':
+            text = "CPA %.2fNM IN %.1fMIN %s/%s" % (cpa, tcpa / 60.0, a.label(), b.label())
+            self.raised += 1
+        else:
+            text = "CLEAR %s/%s" % (a.label(), b.label())
+        # the text may not hold field or checksum delimiters
+        text = text.replace(',', ' ').replace('*', ' ')
+        body = 'AIALR,%s,%03d,%s,V,' % (time.strftime('%H%M%S.00', time.gmtime(now)), state[0], condition)
+        # keep within the 82 characters of an NMEA sentence
+        return format_sentence(body + text[:82 - 6 - len(body)])
+
+    def check(self, target, now):
+        """
+        Compare target with its neighbours, returning any alarm sentences
+        """
+
+        alarms = []
+        scale = math.cos(math.radians(target.lat)) * NM_PER_DEGREE
+        slow = target.sog < self.min_speed
+        for other in self.neighbours(target):
+            if slow and other.sog < self.min_speed:
+                continue
+            self.comparisons += 1
+            cpa, tcpa = self.approach(target, other, now, scale)
+            pair = (min(target.mmsi, other.mmsi), max(target.mmsi, other.mmsi))
+            state = self.alarms.get(pair)
+            if cpa < self.distance and 0.0 <= tcpa <= self.tcpa:
+                if state is None or now - state[1] >= self.repeat:
+                    alarms.append(self.alarm(pair, 'A', cpa, tcpa, now))
+            elif state is not None:
+                alarms.append(self.alarm(pair, 'V', cpa, tcpa, now))
+                del self.alarms[pair]
+        return alarms
+
+    def payloads(self, sentence):
+        """
+        Return the complete payload and fill bits of an AIS message once its
+        last fragment has arrived, otherwise None
+        """
+
+        # !AIVDM,count,number,seqid,channel,payload,fill*hh
+        fields = sentence.split(',')
+        if len(fields) < 7 or fields[0][3:] not in ('VDM', 'VDO'):
+            return None
+        count, number, seqid, channel, payload = fields[1:6]
+        fill = fields[6].split('*', 1)[0]
+        if count in ('', '1'):
+            return payload, fill
+        key = (fields[0], seqid, channel)
+        if number == '1':
+            self.fragments[key] = [payload]
+            return None
+        parts = self.fragments.get(key)
+        if parts is None:
+            return None
+        parts.append(payload)
+        if number != count:
+            return None
+        del self.fragments[key]
+        return ''.join(parts), fill
+
+    def update(self, sentence, now):
+        """
+        Take one sentence from the stream, returning any alarm sentences
+        """
+
+        message = self.payloads(sentence)
+        if message is None:
+            return []
+        payload, fill = message
+        try:
+            aismsg = aislib.decode_payload(payload, int(fill or 0))
+            if aismsg is None:
+                return []
+            mmsi = aismsg.get_attr('mmsi')
+            ais_type = aismsg.get_attr('id')
+            if ais_type in POSITION_TYPES:
+                report = [aismsg.get_attr(name) for name in ('lat', 'lon', 'sog', 'cog')]
+            elif ais_type == 5 or aismsg.get_attr('partno') == 0:
+                name = aislib.AISBits2String(aismsg.get_attr('shipname'))
+            else:
+                # type 24 part B, nothing we need
+                return []
+        except (KeyError, ValueError, IndexError):
+            # garbled or truncated payload
+            self.errors += 1
+            return []
+        self.decoded += 1
+
+        target = self.targets.get(mmsi)
+        if target is None:
+            target = self.targets[mmsi] = Target(mmsi)
+        target.heard = now
+        if ais_type not in POSITION_TYPES:
+            target.name = name
+            return []
+        lat, lon, sog, cog = report
+        # 91 and 181 degrees, 102.3 knots and 360 degrees are "not available"
+        if lat == 91 * 600000 or lon == 181 * 600000 or sog == 1023:
+            return []
+        target.time = now
+        target.set_velocity(sog / 10.0, (cog % 3600) / 10.0)
+        self.move(target, lat / 600000.0, lon / 600000.0)
+        return self.check(target, now)
+
+    def expire(self, now):
+        for mmsi, target in self.targets.items():
+            if now - target.heard > self.max_age:
+                if target.cell is not None:
+                    self.remove_from_grid(target)
+                del self.targets[mmsi]
+        for pair in self.alarms.keys():
+            if pair[0] not in self.targets or pair[1] not in self.targets:
+                del self.alarms[pair]
+
+    def process(self, sentences, now):
+        """
+        Take a batch of sentences, returning the alarm sentences to add to
+        the stream
+        """
+
+        if now >= self.next_expiry:
+            self.expire(now)
+            self.next_expiry = now + 10.0
+        alarms = []
+        for s in sentences:
+            if s[0] == '!':
+                alarms.extend(self.update(s, now))
+        return alarms
+
+    def __str__(self):
+        return "CPA: %d vessels, %d messages decoded, %d errors, %d comparisons, %d alarms raised, %d active" % \
+            (len(self.targets), self.decoded, self.errors, self.comparisons, self.raised, len(self.alarms))
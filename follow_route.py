@@ -121,9 +121,9 @@ class Vessel(object):
             epfd=1, month=5, day=14, hour=20, minute=15,
             destination='CANBERRA')
 
+        # 424 bits, too long for one sentence
         ais = aislib.AIS(aismsg)
-        payload = ais.build_payload(False)
-        return payload
+        return "\n".join(ais.build_sentences())
 
     def __str__(self):
         s = "Vessel %s (%s)" % \
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+"""
+Geographic areas for client subscriptions.
+
+A client can ask for AIS traffic in an area only, a box or a circle:
+
+    SUBSCRIBE box=-34.0,150.9,-33.7,151.4
+    SUBSCRIBE radius=-33.85,151.21,5
+
+The server keeps the last known position of every vessel, from its
+position reports, and an AreaIndex: a grid of cells each listing the
+subscribed areas that overlap it. As each AIS sentence is stored the
+vessel's cell is looked up and only the few areas listed there are
+tested, so the cost does not grow with the number of clients. The areas
+found are kept with the sentence, and a client's subscription then needs
+only a set lookup to decide whether to send it. AIS sentences for a vessel
+whose position is not known, or too old, are in no area and are not sent.
+"""
+
+import math
+from collections import OrderedDict
+
+# nautical miles per degree of latitude
+NM_PER_DEGREE = 60.0
+
+
+class Area(object):
+    """
+    Base class for subscription areas. Sub-classes set the bounds, south,
+    west, north and east in degrees, and implement contains()
+    """
+
+    def contains(self, lat, lon):
+        raise NotImplementedError
+
+
+class Box(Area):
+    """
+    Latitude and longitude box, given as south,west,north,east
+    """
+
+    def __init__(self, south, west, north, east):
+        self.south = min(south, north)
+        self.north = max(south, north)
+        self.west = min(west, east)
+        self.east = max(west, east)
+
+    def contains(self, lat, lon):
+        return self.south <= lat <= self.north and self.west <= lon <= self.east
+
+    def __str__(self):
+        return "box %.4f,%.4f,%.4f,%.4f" % (self.south, self.west, self.north, self.east)
+
+
+class Circle(Area):
+    """
+    Everything within radius nm of a point
+    """
+
+    def __init__(self, lat, lon, radius):
+        self.lat = lat
+        self.lon = lon
+        self.radius = radius
+        self.scale = math.cos(math.radians(lat))
+        height = radius / NM_PER_DEGREE
+        width = height / max(self.scale, 0.01)
+        self.south = lat - height
+        self.north = lat + height
+        self.west = lon - width
+        self.east = lon + width
+
+    def contains(self, lat, lon):
+        dy = lat - self.lat
+        dx = (lon - self.lon) * self.scale
+        return math.hypot(dx, dy) * NM_PER_DEGREE <= self.radius
+
+    def __str__(self):
+        return "radius %.1fnm of %.4f,%.4f" % (self.radius, self.lat, self.lon)
+
+
+def parse_area(key, value):
+    """
+    Build the area for a box= or radius= subscription term, given the
+    numbers in it. Raises ValueError if they do not describe an area.
+    """
+
+    numbers = [float(v) for v in value]
+    if key == 'box':
+        if len(numbers) != 4:
+            raise ValueError("A box is south,west,north,east")
+        return Box(*numbers)
+    if len(numbers) != 3 or numbers[2] <= 0:
+        raise ValueError("A radius is latitude,longitude,nm")
+    return Circle(*numbers)
+
+
+class AreaIndex(object):
+    """
+    The last known position of each vessel, and a grid of the subscribed
+    areas for finding those that contain it.
+
+    Areas that would cover more than max_cells cells of the grid are kept
+    in a separate list and always tested. Positions older than max_age
+    seconds are forgotten, and at most max_vessels are kept.
+    """
+
+    def __init__(self, cell_size=0.1, max_cells=4096, max_age=600.0, max_vessels=1000):
+        # degrees
+        self.cell_size = cell_size
+        self.max_cells = max_cells
+        self.max_age = max_age
+        self.max_vessels = max_vessels
+        # mmsi : (time, (latitude, longitude)), least recently heard first
+        self.positions = OrderedDict()
+        # (row, column) : [areas]
+        self.cells = {}
+        self.large = []
+        self.areas = 0
+
+    def cell(self, lat, lon):
+        return int(math.floor(lat / self.cell_size)), int(math.floor(lon / self.cell_size))
+
+    def area_cells(self, area):
+        south, west = self.cell(area.south, area.west)
+        north, east = self.cell(area.north, area.east)
+        if (north - south + 1) * (east - west + 1) > self.max_cells:
+            return None
+        return [(row, column) for row in range(south, north + 1) for column in range(west, east + 1)]
+
+    def add(self, area):
+        cells = self.area_cells(area)
+        if cells is None:
+            self.large.append(area)
+        else:
+            for cell in cells:
+                self.cells.setdefault(cell, []).append(area)
+        self.areas += 1
+
+    def remove(self, area):
+        cells = self.area_cells(area)
+        if cells is None:
+            self.large.remove(area)
+        else:
+            for cell in cells:
+                members = self.cells[cell]
+                members.remove(area)
+                if not members:
+                    del self.cells[cell]
+        self.areas -= 1
+
+    def expire(self, now):
+        positions = self.positions
+        oldest = now - self.max_age
+        while positions:
+            mmsi, (heard, position) = next(iter(positions.items()))
+            if heard >= oldest:
+                break
+            del positions[mmsi]
+
+    def update(self, info, now):
+        """
+        Record the position in an AIS position report, and set info.areas
+        to the areas that contain the vessel an AIS sentence describes
+        """
+
+        if info.ais_type is None:
+            return
+        position = info.position
+        if position is not None:
+            positions = self.positions
+            positions.pop(info.mmsi, None)
+            positions[info.mmsi] = (now, position)
+            if len(positions) > self.max_vessels:
+                positions.popitem(last=False)
+            self.expire(now)
+        if not self.areas:
+            return
+        if position is None:
+            heard, position = self.positions.get(info.mmsi, (None, None))
+            if position is None or heard < now - self.max_age:
+                # nowhere we know of
+                info.areas = ()
+                return
+        lat, lon = position
+        candidates = self.cells.get(self.cell(lat, lon), ())
+        if self.large:
+            candidates = list(candidates) + self.large
+        info.areas = frozenset(area for area in candidates if area.contains(lat, lon))
+
+    def __str__(self):
+        return "Areas: %d subscribed, %d grid cells, %d vessel positions" % \
+            (self.areas, len(self.cells), len(self.positions))
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+
+"""
+Ingest stages applied to each batch of sentences read from a source before
+it is stored for distribution.
+
+Each stage takes a list of sentences and returns the ones to keep, so the
+work is done once, centrally, rather than by every client.
+"""
+
+import string
+import sys
+import time
+from collections import OrderedDict
+
+import aislib
+import nmea
+
+
+class SentenceValidator(object):
+    """
+    Checks the framing and checksum of every sentence, so that torn lines,
+    serial noise and corrupted sentences are dropped once here instead of
+    being sent to, and rejected by, every client.
+
+    A sentence must start with $ or !, end with a *hh checksum that matches
+    the XOR of the characters in between, and be at most max_length
+    characters long including the line ending. Rejected sentences are
+    counted by source and reason, and optionally appended to a quarantine
+    log for inspection.
+    """
+
+    REASONS = ('start', 'length', 'trailer', 'checksum')
+
+    def __init__(self, max_length=82, quarantine=None):
+        self.max_length = max_length
+        self.quarantine = None
+        if quarantine:
+            self.quarantine = open(quarantine, 'a')
+        # source tag : {reason : count}
+        self.rejected = {}
+
+    def check(self, sentence):
+        """
+        Return None if the sentence is valid, otherwise why it is not
+        """
+
+        if sentence[:1] not in ('$', '!'):
+            return 'start'
+        if len(sentence) > self.max_length:
+            return 'length'
+        line = sentence.rstrip('\r\n')
+        if len(line) < 4 or line[-3] != '*' or line[-2] not in string.hexdigits or \
+                line[-1] not in string.hexdigits:
+            return 'trailer'
+        if aislib.nmea_checksum(line[1:-3]) != int(line[-2:], 16):
+            return 'checksum'
+        return None
+
+    def filter(self, sentences, tag):
+        """
+        Return the valid sentences of a batch read from source tag
+        """
+
+        kept = []
+        for sentence in sentences:
+            reason = self.check(sentence)
+            if reason is None:
+                kept.append(sentence)
+                continue
+            counts = self.rejected.get(tag)
+            if counts is None:
+                counts = self.rejected[tag] = dict((r, 0) for r in self.REASONS)
+            counts[reason] += 1
+            if self.quarantine is not None:
+                self.quarantine.write('%.3f %s %s %r\n' % (time.time(), tag, reason, sentence))
+        if self.quarantine is not None and len(kept) != len(sentences):
+            self.quarantine.flush()
+        return kept
+
+    def __str__(self):
+        return "Rejected sentences: " + ', '.join('%s %s' % (tag, ' '.join('%s=%d' % (r, counts[r])
+                                                                         for r in self.REASONS))
+                                                for tag, counts in sorted(self.rejected.items()))
+
+
+class DuplicateFilter(object):
+    """
+    Drops AIS sentences already seen within the last window seconds.
+
+    With two AIS receivers, or a receiver and a simulated source, the same
+    message arrives more than once. Sentences are identified by a hash of
+    their fragment numbers and payload, which are the same whichever
+    receiver (talker) or channel they came from. The later fragments of a
+    multi-sentence message are often alike (the padding at the end of a
+    type 5), so their hash also covers the payload of the first fragment,
+    remembered by source, sequential message id and channel, as the
+    sequential ids of two receivers need not agree. The hashes are kept in
+    the order first seen, so expired entries are always at the front; at
+    most max_entries are kept and the first seen are evicted first. A
+    duplicate does not refresh its entry, so the window runs from the
+    first arrival of a message.
+    """
+
+    def __init__(self, window=2.0, max_entries=4096):
+        self.window = window
+        self.max_entries = max_entries
+        # hash : time first seen
+        self.seen = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # (source tag, seqid, channel) : payload of the first fragment of
+        # the multi-sentence message being received
+        self.first = {}
+
+    def key(self, sentence, tag):
+        # !AIVDM,count,number,seqid,channel,payload,fill*hh
+        fields = sentence.split(',', 7)
+        if len(fields) < 7:
+            return hash(sentence.rstrip())
+        count, number, seqid, channel, payload = fields[1:6]
+        first = ''
+        if number == '1':
+            if count != '1':
+                self.first[(tag, seqid, channel)] = payload
+        else:
+            first = self.first.get((tag, seqid, channel), '')
+        # leave out the checksum, it covers the talker and channel too
+        return hash((count, number, first, payload, fields[6].split('*', 1)[0]))
+
+    def expire(self, now):
+        seen = self.seen
+        oldest = now - self.window
+        while seen:
+            key, first_seen = next(iter(seen.items()))
+            if first_seen > oldest:
+                break
+            del seen[key]
+
+    def filter(self, sentences, now, tag):
+        """
+        Return the sentences of a batch read from source tag that are not
+        duplicates. Only AIS sentences (starting with !) are checked.
+        """
+
+        self.expire(now)
+        seen = self.seen
+        kept = []
+        for sentence in sentences:
+            if not sentence.startswith('!'):
+                kept.append(sentence)
+                continue
+            key = self.key(sentence, tag)
+            if key in seen:
+                self.hits += 1
+                continue
+            self.misses += 1
+            seen[key] = now
+            if len(seen) > self.max_entries:
+                seen.popitem(last=False)
+                self.evictions += 1
+            kept.append(sentence)
+        return kept
+
+    def hit_rate(self):
+        checked = self.hits + self.misses
+        if checked == 0:
+            return 0.0
+        return float(self.hits) / checked
+
+    def memory(self):
+        # approximate bytes used by the table: the dictionary itself plus,
+        # for each entry, the hash, the time and the ordering link
+        if not self.seen:
+            return sys.getsizeof(self.seen)
+        key, first_seen = next(iter(self.seen.items()))
+        entry = sys.getsizeof(key) + sys.getsizeof(first_seen) + sys.getsizeof([None, None, None])
+        return sys.getsizeof(self.seen) + len(self.seen) * entry
+
+    def __str__(self):
+        return "Duplicate filter: %d duplicates dropped, hit rate %.1f%%, %d entries (%d evicted), ~%d bytes" % \
+            (self.hits, 100.0 * self.hit_rate(), len(self.seen), self.evictions, self.memory())
+
+
+class LatestState(object):
+    """
+    The latest known state of every vessel and instrument, kept as the raw
+    sentences that reported it, so that a newly connected client can be
+    sent a snapshot straight away instead of waiting for the next reports.
+
+    For each MMSI the last position report (types 1, 2, 3, 18, 19) and the
+    last static data (type 5, and both parts of type 24) are kept; for
+    every other sentence address (GPS fixes, wind, depth and so on) just
+    the last sentence. Alarms, which are only news when raised, and the
+    satellites in view, sent as a set of sentences of which only the last
+    would be kept, are left out. Vessels not heard from for max_age
+    seconds are forgotten, and at most max_vessels are kept. A snapshot
+    can be limited to what a client's subscription selects.
+    """
+
+    POSITION_TYPES = (1, 2, 3, 18, 19)
+    STATIC_TYPES = (5, 24)
+    # sentence formatters not kept
+    TRANSIENT = ('ALR', 'GSV')
+
+    def __init__(self, max_age=600.0, max_vessels=1000):
+        self.max_age = max_age
+        self.max_vessels = max_vessels
+        # mmsi : {kind : (time, [sentences], SentenceInfo)}, least recently
+        # heard first
+        self.vessels = OrderedDict()
+        # address : (time, sentence, SentenceInfo)
+        self.latest = {}
+        # fragments of multi-sentence AIS messages being collected,
+        # (address, seqid, channel) : [sentences]
+        self.fragments = {}
+
+    def kind(self, sentence, info):
+        """
+        Return which kind of AIS report this is, None for those not kept
+        """
+
+        if info.ais_type in self.POSITION_TYPES:
+            return 'position'
+        if info.ais_type == 5:
+            return 'static'
+        if info.ais_type == 24:
+            # part A and B carry different data, keep both. The part
+            # number is in bits 38-39, the middle of the 7th character
+            payload = sentence.split(',', 6)[5]
+            if len(payload) > 6:
+                return 'static%d' % ((aislib.re_encodingchars.get(payload[6], 0) >> 2) & 3)
+        return None
+
+    def update(self, sentence, info, now):
+        if info.ais_type is None:
+            formatter = info.address[2:]
+            if formatter not in nmea.AIS_FORMATTERS and formatter not in self.TRANSIENT:
+                self.latest[info.address] = (now, sentence, info)
+            return
+        # !AIVDM,count,number,seqid,channel,...
+        fields = sentence.split(',', 5)
+        if len(fields) < 6:
+            return
+        count, number, seqid, channel = fields[1:5]
+        if count not in ('', '1'):
+            key = (info.address, seqid, channel)
+            if number == '1':
+                self.fragments[key] = [sentence]
+                return
+            group = self.fragments.get(key)
+            if group is None:
+                # we missed the start of this message
+                return
+            group.append(sentence)
+            if number != count:
+                return
+            del self.fragments[key]
+            sentences = group
+        else:
+            sentences = [sentence]
+        kind = self.kind(sentences[0], info)
+        if kind is None:
+            return
+        vessel = self.vessels.pop(info.mmsi, None)
+        if vessel is None:
+            vessel = {}
+        vessel[kind] = (now, sentences, info)
+        self.vessels[info.mmsi] = vessel
+        if len(self.vessels) > self.max_vessels:
+            self.vessels.popitem(last=False)
+
+    def expire(self, now):
+        oldest = now - self.max_age
+        for mmsi, vessel in self.vessels.items():
+            for kind, (heard, sentences, info) in vessel.items():
+                if heard < oldest:
+                    del vessel[kind]
+            if not vessel:
+                del self.vessels[mmsi]
+        for address, (heard, sentence, info) in self.latest.items():
+            if heard < oldest:
+                del self.latest[address]
+
+    def snapshot(self, now, subscription=None):
+        """
+        Return the sentences describing the current state: instruments
+        first, then each vessel's static data followed by its position.
+        With a Subscription, only those it selects.
+        """
+
+        self.expire(now)
+        if subscription is None:
+            sentences = [sentence for heard, sentence, info in self.latest.values()]
+        else:
+            sentences = [sentence for heard, sentence, info in self.latest.values() if subscription.matches(info)]
+        for vessel in self.vessels.values():
+            position = None
+            if subscription is not None and 'position' in vessel:
+                position = vessel['position'][2].position
+            for kind in sorted(vessel.keys(), reverse=True):
+                heard, group, info = vessel[kind]
+                if subscription is None or subscription.matches_at(info, position):
+                    sentences.extend(group)
+        return sentences
+
+    def __str__(self):
+        return "Latest state: %d vessels, %d other sentences" % (len(self.vessels), len(self.latest))
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+"""
+Latency tracing through the server.
+
+With server.py --trace N one sentence in N is followed from the moment it
+is read from its source, through being stored in the ring, to the moment
+the last byte of the batch holding it has been handed to each client's
+socket. The delays go into histograms, one for ingest (read to ring) and
+one per client (ring to socket), which are printed with the other
+statistics on SIGUSR1 and served as quantiles on the --stats-port.
+
+Times are taken from a monotonic clock, so a clock step by NTP or the GPS
+does not show up as a huge or negative delay.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import time
+
+CLOCK_MONOTONIC = 1
+
+
+class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _monotonic_clock():
+    """
+    Return a function giving seconds from a monotonic clock: time.monotonic
+    where there is one, otherwise clock_gettime through ctypes, and as a
+    last resort time.time
+    """
+
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        clock_gettime = libc.clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    t = timespec()
+    ref = ctypes.byref(t)
+
+    def monotonic():
+        if clock_gettime(CLOCK_MONOTONIC, ref) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return t.tv_sec + t.tv_nsec * 1e-9
+
+    return monotonic
+
+
+monotonic = _monotonic_clock()
+
+
+class Histogram(object):
+    """
+    Log-linear histogram of delays, in the style of HdrHistogram.
+
+    Values are recorded in microseconds. Each power of two is split into
+    sub_buckets equal buckets, so every value is counted to within
+    1/sub_buckets of itself (about 6% with the default 16) whatever its
+    size, in a few hundred counters at most.
+    """
+
+    def __init__(self, sub_buckets=16):
+        self.sub_buckets = sub_buckets
+        self.shift = sub_buckets.bit_length() - 1
+        self.counts = []
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def bucket(self, value):
+        if value < self.sub_buckets:
+            return value
+        e = value.bit_length() - 1 - self.shift
+        return (e + 1) * self.sub_buckets + (value >> e) - self.sub_buckets
+
+    def lowest(self, bucket):
+        # smallest value counted in a bucket
+        if bucket < self.sub_buckets:
+            return bucket
+        e = bucket // self.sub_buckets - 1
+        return (bucket % self.sub_buckets + self.sub_buckets) << e
+
+    def record(self, seconds):
+        value = max(0, int(seconds * 1e6))
+        i = self.bucket(value)
+        if i >= len(self.counts):
+            self.counts.extend([0] * (i + 1 - len(self.counts)))
+        self.counts[i] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """
+        Return the delay, in seconds, that p percent of the values are at
+        or below (to the resolution of the buckets)
+        """
+
+        if not self.count:
+            return 0.0
+        target = max(1, int(round(p / 100.0 * self.count)))
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                # the middle of the bucket, but never beyond the largest value
+                return min(self.max, (self.lowest(i) + self.lowest(i + 1)) // 2) / 1e6
+        return self.max / 1e6
+
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return self.total / 1e6 / self.count
+
+    def __str__(self):
+        return "%d samples, mean %.2fms p50 %.2fms p90 %.2fms p99 %.2fms p99.9 %.2fms max %.2fms" % \
+            (self.count, self.mean() * 1e3, self.percentile(50) * 1e3, self.percentile(90) * 1e3,
+             self.percentile(99) * 1e3, self.percentile(99.9) * 1e3, self.max / 1e3)
+
+
+class Tracer(object):
+    """
+    Samples one sentence in every and keeps the time each sampled sentence
+    was stored in the ring, for as long as it may still be in the ring
+    """
+
+    def __init__(self, every=100):
+        self.every = every
+        # sequence number : time stored in the ring
+        self.enqueued = {}
+        self.oldest = 0
+        self.ingest = Histogram()
+
+    def sampled(self, seq):
+        return seq % self.every == 0
+
+    def enqueue(self, ring, start, read_time):
+        """
+        Note the sentences start .. ring.head just stored in the ring, which
+        were read from their source at read_time
+        """
+
+        now = monotonic()
+        first = start + (-start % self.every)
+        for seq in range(first, ring.head, self.every):
+            self.enqueued[seq] = now
+            self.ingest.record(now - read_time)
+        # forget sentences that have gone from the ring
+        tail = ring.tail()
+        while self.oldest < tail:
+            self.enqueued.pop(self.oldest, None)
+            self.oldest += self.every
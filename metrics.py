@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+
+"""
+Live metrics for the distribution server.
+
+The server counts what it reads and writes as it goes (a dictionary
+increment or an addition per batch, cheap enough to leave on all the time)
+and serves the counters on the --stats-port as Prometheus text exposition:
+
+    curl http://raspberrypi:10001/
+    nc raspberrypi 10001
+
+Rates (sentences/s, bytes/s) are exponentially weighted averages updated
+every few seconds; Prometheus can also compute them from the _total
+counters.
+"""
+
+import errno
+import functools
+import socket
+import time
+
+from nmea import sentence_address
+
+
+def label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def add_metric(lines, name, kind, help_text, samples):
+    """
+    Append a metric, with its help and type lines, in Prometheus text format
+    """
+
+    lines.append('# HELP %s %s' % (name, help_text))
+    lines.append('# TYPE %s %s' % (name, kind))
+    for labels, value in samples:
+        if labels:
+            lines.append('%s{%s} %s' % (name, ','.join('%s="%s"' % (k, label(v)) for k, v in labels), value))
+        else:
+            lines.append('%s %s' % (name, value))
+
+
+class Metrics(object):
+    """
+    Counters and timings collected by the server's event loop
+    """
+
+    # parts of each pass round the event loop that are timed
+    STAGES = ('select', 'accept', 'ingest', 'client_input', 'write', 'schedule', 'udp_output')
+
+    def __init__(self, rate_interval=5.0, smoothing=0.5):
+        self.started = time.time()
+        self.rate_interval = rate_interval
+        self.smoothing = smoothing
+        # (source tag, sentence address) : [sentences, bytes]
+        self.received = {}
+        # source tag : [sentences/s, bytes/s], and the totals last time
+        self.source_rates = {}
+        self.source_totals = {}
+        self.last_tick = self.started
+        self.iterations = 0
+        self.stage_seconds = dict((stage, 0.0) for stage in self.STAGES)
+        self.stage_calls = dict((stage, 0) for stage in self.STAGES)
+        self.longest_iteration = 0.0
+
+    def stage(self, name, seconds):
+        self.stage_seconds[name] += seconds
+        self.stage_calls[name] += 1
+
+    def iteration(self, seconds):
+        self.iterations += 1
+        if seconds > self.longest_iteration:
+            self.longest_iteration = seconds
+
+    def ingest(self, tag, ring, start, end):
+        """
+        Count sentences start .. end of the ring, just read from source tag
+        """
+
+        received = self.received
+        for seq in range(start, end):
+            key = (tag, ring.info(seq).address)
+            counts = received.get(key)
+            if counts is None:
+                counts = received[key] = [0, 0]
+            counts[0] += 1
+            counts[1] += len(ring.get(seq))
+
+    def count(self, tag, sentences):
+        """
+        Count sentences just read from source tag, where there is no ring
+        (the ingest process of --workers)
+        """
+
+        received = self.received
+        for sentence in sentences:
+            key = (tag, sentence_address(sentence))
+            counts = received.get(key)
+            if counts is None:
+                counts = received[key] = [0, 0]
+            counts[0] += 1
+            counts[1] += len(sentence)
+
+    def smooth(self, old, new):
+        if old is None:
+            return new
+        return self.smoothing * new + (1.0 - self.smoothing) * old
+
+    def tick(self, now, clients):
+        """
+        Update the rates, at most once every rate_interval seconds
+        """
+
+        elapsed = now - self.last_tick
+        if elapsed < self.rate_interval:
+            return
+        self.last_tick = now
+        totals = {}
+        for (tag, address), (sentences, size) in self.received.items():
+            total = totals.setdefault(tag, [0, 0])
+            total[0] += sentences
+            total[1] += size
+        for tag, (sentences, size) in totals.items():
+            last = self.source_totals.get(tag, (0, 0))
+            rates = self.source_rates.get(tag, (None, None))
+            self.source_rates[tag] = (self.smooth(rates[0], (sentences - last[0]) / elapsed),
+                                      self.smooth(rates[1], (size - last[1]) / elapsed))
+        self.source_totals = totals
+        for client in clients:
+            rate = (client.bytes_sent - client.rate_mark) / elapsed
+            client.send_rate = self.smooth(client.send_rate, rate)
+            client.rate_mark = client.bytes_sent
+
+    def source_metrics(self, lines, now):
+        metric = functools.partial(add_metric, lines)
+        metric('nmea_uptime_seconds', 'gauge', 'Seconds since the server started',
+               [((), '%.1f' % (now - self.started))])
+        metric('nmea_sentences_received_total', 'counter', 'Sentences received by source and address',
+               [((('source', tag), ('address', address)), counts[0])
+                for (tag, address), counts in sorted(self.received.items())])
+        metric('nmea_bytes_received_total', 'counter', 'Bytes received by source and address',
+               [((('source', tag), ('address', address)), counts[1])
+                for (tag, address), counts in sorted(self.received.items())])
+        metric('nmea_source_sentences_per_second', 'gauge', 'Recent sentences per second by source',
+               [((('source', tag),), '%.2f' % rates[0]) for tag, rates in sorted(self.source_rates.items())])
+        metric('nmea_source_bytes_per_second', 'gauge', 'Recent bytes per second by source',
+               [((('source', tag),), '%.1f' % rates[1]) for tag, rates in sorted(self.source_rates.items())])
+
+    def stage_metrics(self, lines, duplicates=None, validator=None, cpa=None):
+        # the ingest stages
+        metric = functools.partial(add_metric, lines)
+        if validator is not None:
+            metric('nmea_sentences_rejected_total', 'counter', 'Invalid sentences dropped by source and reason',
+                   [((('source', tag), ('reason', reason)), counts[reason])
+                    for tag, counts in sorted(validator.rejected.items()) for reason in validator.REASONS])
+        if duplicates is not None:
+            metric('nmea_duplicates_dropped_total', 'counter', 'Duplicate AIS sentences dropped',
+                   [((), duplicates.hits)])
+        if cpa is not None:
+            metric('nmea_cpa_vessels', 'gauge', 'Vessels tracked for collision alarms', [((), len(cpa.targets))])
+            metric('nmea_cpa_alarms_total', 'counter', 'Collision alarms raised', [((), cpa.raised)])
+            metric('nmea_cpa_errors_total', 'counter', 'AIS messages the collision alarms could not decode',
+                   [((), cpa.errors)])
+
+    def ingest_exposition(self, now, pipes, duplicates=None, validator=None, cpa=None):
+        """
+        Return the metrics of the ingest process of --workers in Prometheus
+        text format: what it reads, the ingest stages, and what it passes
+        on to each worker
+        """
+
+        lines = []
+        self.source_metrics(lines, now)
+        self.stage_metrics(lines, duplicates, validator, cpa)
+        workers = [(('worker', pipe.pid),) for pipe in pipes]
+        add_metric(lines, 'nmea_worker_queue_bytes', 'gauge', 'Bytes waiting to be written to each worker',
+                   [(worker, pipe.pending_bytes) for worker, pipe in zip(workers, pipes)])
+        add_metric(lines, 'nmea_worker_dropped_total', 'counter',
+                   'Sentences dropped for each worker that fell behind, which its clients do not see',
+                   [(worker, pipe.dropped) for worker, pipe in zip(workers, pipes)])
+        add_metric(lines, 'nmea_worker_up', 'gauge', 'Whether each worker is still running',
+                   [(worker, int(not pipe.closed)) for worker, pipe in zip(workers, pipes)])
+        return '\n'.join(lines) + '\n'
+
+    def exposition(self, now, ring, clients, udp_outputs=(), duplicates=None, validator=None, tracer=None,
+                   cpa=None):
+        """
+        Return the metrics in Prometheus text format
+        """
+
+        lines = []
+        metric = functools.partial(add_metric, lines)
+        self.source_metrics(lines, now)
+        metric('nmea_ring_sentences', 'gauge', 'Sentences held in the ring', [((), len(ring))])
+        metric('nmea_clients', 'gauge', 'Connected clients', [((), len(clients))])
+
+        samples = dict((name, []) for name in ('pending', 'pending_bytes', 'sent', 'sends', 'rate',
+                                               'dropped_oldest', 'dropped_newest', 'dropped_stale'))
+        for client in clients:
+            peer = (('client', '%s:%s' % client.address),)
+            samples['pending'].append((peer, client.pending(ring)))
+            samples['pending_bytes'].append((peer, client.pending_bytes(ring) + client.unsent()))
+            samples['sent'].append((peer, client.bytes_sent))
+            samples['sends'].append((peer, client.sends))
+            samples['rate'].append((peer, '%.1f' % (client.send_rate or 0.0)))
+            samples['dropped_oldest'].append((peer, client.dropped_oldest))
+            samples['dropped_newest'].append((peer, client.dropped_newest))
+            samples['dropped_stale'].append((peer, client.dropped_stale))
+        metric('nmea_client_queue_sentences', 'gauge', 'Sentences waiting for each client', samples['pending'])
+        metric('nmea_client_queue_bytes', 'gauge', 'Bytes waiting for each client', samples['pending_bytes'])
+        metric('nmea_client_bytes_sent_total', 'counter', 'Bytes sent to each client', samples['sent'])
+        metric('nmea_client_sends_total', 'counter', 'Send calls for each client', samples['sends'])
+        metric('nmea_client_bytes_per_second', 'gauge', 'Recent bytes per second sent to each client',
+               samples['rate'])
+        metric('nmea_client_dropped_total', 'counter', 'Sentences dropped for each client',
+               [(peer + (('end', 'oldest'),), value) for peer, value in samples['dropped_oldest']] +
+               [(peer + (('end', 'newest'),), value) for peer, value in samples['dropped_newest']] +
+               [(peer + (('end', 'stale'),), value) for peer, value in samples['dropped_stale']])
+
+        if udp_outputs:
+            metric('nmea_udp_datagrams_total', 'counter', 'Datagrams sent to each UDP output',
+                   [((('output', '%s:%s' % output.address),), output.datagrams) for output in udp_outputs])
+            metric('nmea_udp_dropped_total', 'counter', 'Sentences dropped by each UDP output',
+                   [((('output', '%s:%s' % output.address),), output.dropped) for output in udp_outputs])
+        self.stage_metrics(lines, duplicates, validator, cpa)
+
+        if tracer is not None:
+            def quantiles(labels, histogram):
+                return [(labels + (('quantile', q),), '%.6f' % histogram.percentile(float(q) * 100))
+                        for q in ('0.5', '0.9', '0.99', '0.999')] + \
+                       [(labels + (('quantile', '1'),), '%.6f' % (histogram.max / 1e6))]
+            metric('nmea_ingest_latency_seconds', 'summary',
+                   'Delay from reading a sentence from its source to storing it in the ring (sampled)',
+                   quantiles((), tracer.ingest))
+            samples = []
+            for client in clients:
+                if client.latency is not None:
+                    samples.extend(quantiles((('client', '%s:%s' % client.address),), client.latency))
+            metric('nmea_client_latency_seconds', 'summary',
+                   'Delay from storing a sentence in the ring to writing it to each client (sampled)', samples)
+
+        metric('nmea_loop_iterations_total', 'counter', 'Passes round the event loop', [((), self.iterations)])
+        metric('nmea_loop_longest_seconds', 'gauge', 'Longest pass round the event loop, excluding select',
+               [((), '%.6f' % self.longest_iteration)])
+        metric('nmea_stage_seconds_total', 'counter', 'Time spent in each stage of the event loop',
+               [((('stage', stage),), '%.6f' % self.stage_seconds[stage]) for stage in self.STAGES])
+        metric('nmea_stage_calls_total', 'counter', 'Times each stage of the event loop ran',
+               [((('stage', stage),), self.stage_calls[stage]) for stage in self.STAGES])
+        return '\n'.join(lines) + '\n'
+
+
+class StatsConnection(object):
+    """
+    One connection to the stats port. Prometheus and curl send an HTTP
+    request, which ends with a blank line; plain nc sends nothing, so the
+    metrics are also sent once wait seconds have passed without one.
+    """
+
+    def __init__(self, sock, now, wait=0.1):
+        self.sock = sock
+        self.request = ''
+        self.respond_at = now + wait
+        # the response still to be written, None until there is one
+        self.response = None
+
+    def receive(self, now):
+        """
+        Read what the peer has sent. Returns False if the connection has
+        failed.
+        """
+
+        try:
+            data = self.sock.recv(4096)
+        except socket.error as e:
+            return e.args[0] in (errno.EAGAIN, errno.EINTR)
+        # keep only enough to spot the end of the request
+        self.request = self.request[-3:] + data
+        if not data or '\r\n\r\n' in self.request or '\n\n' in self.request:
+            self.respond_at = now
+        return True
+
+    def respond(self, body):
+        self.response = 'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n' \
+                        'Content-Length: %d\r\n\r\n' % len(body) + body
+
+    def send(self):
+        """
+        Write as much of the response as the socket will take. Returns
+        True once all of it has been written.
+        """
+
+        try:
+            sent = self.sock.send(self.response)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return False
+            raise
+        self.response = self.response[sent:]
+        return not self.response
+
+
+class StatsServer(object):
+    """
+    Serves the metrics on a TCP port from the event loop, without ever
+    blocking it: requests are read when their sockets are readable and
+    the responses written when they are writeable. A connection not
+    finished within timeout seconds is dropped.
+
+    exposition(now) returns the metrics text. The event loop adds
+    readers() and writers() to its select and passes what is ready to
+    read() and write().
+    """
+
+    def __init__(self, port, exposition, timeout=5.0):
+        self.exposition = exposition
+        self.timeout = timeout
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.setblocking(0)
+        self.listener.bind(('', port))
+        self.listener.listen(5)
+        # socket : StatsConnection
+        self.connections = {}
+        # socket : time it is dropped
+        self.expires = {}
+        self.served = 0
+
+    def readers(self):
+        return [self.listener] + [s for s, c in self.connections.items() if c.response is None]
+
+    def writers(self):
+        return [s for s, c in self.connections.items() if c.response is not None]
+
+    def close(self, s):
+        del self.connections[s]
+        del self.expires[s]
+        s.close()
+
+    def read(self, s, now):
+        if s is self.listener:
+            try:
+                sock, address = s.accept()
+            except socket.error:
+                # gone again before we got to it
+                return
+            sock.setblocking(0)
+            self.connections[sock] = StatsConnection(sock, now)
+            self.expires[sock] = now + self.timeout
+            return
+        connection = self.connections[s]
+        if not connection.receive(now):
+            self.close(s)
+        elif connection.respond_at <= now:
+            connection.respond(self.exposition(now))
+
+    def write(self, s):
+        try:
+            done = self.connections[s].send()
+        except socket.error:
+            self.close(s)
+            return
+        if done:
+            self.served += 1
+            try:
+                s.shutdown(socket.SHUT_WR)
+            except socket.error:
+                pass
+            self.close(s)
+
+    def schedule(self, now):
+        """
+        Respond to the connections that have waited long enough for a
+        request and drop those that have taken too long. Returns the time
+        until something next falls due, or None.
+        """
+
+        timeout = None
+        for s, connection in self.connections.items():
+            if now >= self.expires[s]:
+                self.close(s)
+                continue
+            if connection.response is None:
+                if now >= connection.respond_at:
+                    connection.respond(self.exposition(now))
+                    continue
+                due = connection.respond_at
+            else:
+                due = self.expires[s]
+            if timeout is None or due - now < timeout:
+                timeout = due - now
+        return timeout
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""
+Helpers for looking inside NMEA 0183 sentences.
+
+The server parses each sentence once as it arrives and keeps the result
+with the sentence, so per-client decisions (subscriptions and so on) never
+have to parse it again.
+"""
+
+import aislib
+
+# AIS sentence formatters: own vessel (VDO) and other vessels (VDM)
+AIS_FORMATTERS = ('VDM', 'VDO')
+
+
+class SentenceInfo(object):
+    """
+    What the server knows about a sentence.
+
+    address     talker and formatter, e.g. GPRMC or AIVDM
+    ais_type    AIS message type, or None if this is not an AIS sentence
+    mmsi        MMSI of the vessel an AIS sentence describes, or None
+    position    (latitude, longitude) reported by an AIS position report
+    areas       subscription areas the vessel is in, set by an AreaIndex
+    lane        priority lane, 0 the highest, set by PriorityLanes
+    """
+
+    __slots__ = ('address', 'ais_type', 'mmsi', 'position', 'areas', 'lane')
+
+    def __init__(self, address, ais_type=None, mmsi=None, position=None):
+        self.address = address
+        self.ais_type = ais_type
+        self.mmsi = mmsi
+        self.position = position
+        self.areas = None
+        self.lane = 0
+
+    def __str__(self):
+        if self.ais_type is None:
+            return self.address
+        return "%s type %d from %d" % (self.address, self.ais_type, self.mmsi)
+
+
+def sentence_address(sentence):
+    """
+    Return the address field of a sentence, the text between the $ or !
+    and the first comma, e.g. GPRMC
+    """
+
+    comma = sentence.find(',')
+    if comma < 0:
+        return sentence[1:].rstrip()
+    return sentence[1:comma]
+
+
+class SentenceParser(object):
+    """
+    Builds the SentenceInfo for each sentence.
+
+    The AIS header (message type and MMSI) is only in the first fragment
+    of a multi-sentence message, so it is remembered by sequential message
+    ID and channel and given to the following fragments as well.
+    """
+
+    def __init__(self):
+        # (talker, sequential message id, channel) : (ais_type, mmsi)
+        self.fragments = {}
+
+    def parse(self, sentence):
+        address = sentence_address(sentence)
+        if address[2:] not in AIS_FORMATTERS:
+            return SentenceInfo(address)
+        # !AIVDM,count,number,seqid,channel,payload,fill*hh
+        fields = sentence.split(',')
+        if len(fields) < 7:
+            return SentenceInfo(address)
+        count, number, seqid, channel, payload = fields[1:6]
+        key = (address, seqid, channel)
+        if number in ('', '1'):
+            try:
+                view = aislib.AISMessageView(payload)
+            except ValueError:
+                return SentenceInfo(address)
+            if count in ('', '1'):
+                return SentenceInfo(address, view.id, view.mmsi, view.position())
+            self.fragments[key] = (view.id, view.mmsi)
+            return SentenceInfo(address, view.id, view.mmsi)
+        header = self.fragments.get(key)
+        if number == count:
+            self.fragments.pop(key, None)
+        if header is None:
+            return SentenceInfo(address)
+        return SentenceInfo(address, header[0], header[1])
@@ -1,2 +1,7 @@
 #!/bin/bash
-./server.py
+# each source service writes to its own FIFO, so their sentences are never
+# interleaved; ./nmea_fifo stays for ad hoc writers such as recorder.py replay
+for fifo in ./nmea_fifo ./ruby_princess_fifo ./trilogy_fifo; do
+    [ -p $fifo ] || mkfifo $fifo
+done
+./server.py -s fifo:./nmea_fifo -s ruby=fifo:./ruby_princess_fifo -s trilogy=fifo:./trilogy_fifo
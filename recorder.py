@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+"""
+Record the NMEA stream and replay it.
+
+The server appends every sentence it distributes, with the time it arrived,
+to a log file (server.py --record passage.log). The log is a sequence of
+records
+
+    time (8 byte double) | length (2 byte unsigned) | sentence
+
+and next to it passage.log.idx holds an index entry (time, offset of the
+first record at or after that time) every few seconds, so a replay can
+start anywhere in a long passage without reading what comes before.
+
+Replay writes the sentences to stdout at the recorded pace, or faster:
+
+    ./recorder.py replay passage.log --speed 10 > ./nmea_fifo
+
+The log is memory mapped, so nothing is read until it is needed.
+"""
+
+import argparse
+import calendar
+import mmap
+import os
+import struct
+import sys
+import time
+from datetime import datetime as dt
+
+RECORD = struct.Struct('<dH')
+INDEX_ENTRY = struct.Struct('<dQ')
+
+
+def repair(path):
+    """
+    Cut off a record left part written when the recorder last stopped,
+    e.g. by a crash or power failure, and any index entries beyond it, so
+    that new records follow the last complete one. Returns the length of
+    the log.
+    """
+
+    if not os.path.exists(path):
+        return 0
+    size = os.path.getsize(path)
+    entries = []
+    index_size = 0
+    if os.path.exists(path + '.idx'):
+        with open(path + '.idx', 'rb') as index:
+            data = index.read()
+        index_size = len(data)
+        entries = [INDEX_ENTRY.unpack_from(data, i) for i in range(0, len(data) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size)]
+
+    # records before the last index entry within the log were complete
+    # when it was written, so only the records after it need checking
+    offset = 0
+    for t, entry_offset in entries:
+        if entry_offset <= size:
+            offset = entry_offset
+    with open(path, 'r+b') as log:
+        log.seek(offset)
+        while offset + RECORD.size <= size:
+            t, length = RECORD.unpack(log.read(RECORD.size))
+            if offset + RECORD.size + length > size:
+                break
+            log.seek(length, os.SEEK_CUR)
+            offset += RECORD.size + length
+        if offset < size:
+            print >>sys.stderr, "%s: cut %d bytes of a partly written record" % (path, size - offset)
+            log.truncate(offset)
+
+    kept = [entry for entry in entries if entry[1] <= offset]
+    if len(kept) * INDEX_ENTRY.size != index_size:
+        with open(path + '.idx', 'wb') as index:
+            index.write(''.join(INDEX_ENTRY.pack(*entry) for entry in kept))
+    return offset
+
+
+class Recorder(object):
+    """
+    Appends sentences to a log and its index
+    """
+
+    def __init__(self, path, index_interval=10.0):
+        self.path = path
+        self.index_interval = index_interval
+        self.offset = repair(path)
+        self.log = open(path, 'ab')
+        self.index = open(path + '.idx', 'ab')
+        # start a new index entry with the first record written
+        self.next_index = 0.0
+        self.sentences = 0
+
+    def write(self, sentences, now):
+        """
+        Append a batch of sentences that arrived at time now
+        """
+
+        if not sentences:
+            return
+        if now >= self.next_index:
+            self.index.write(INDEX_ENTRY.pack(now, self.offset))
+            self.index.flush()
+            self.next_index = now + self.index_interval
+        records = []
+        for sentence in sentences:
+            records.append(RECORD.pack(now, len(sentence)))
+            records.append(sentence)
+            self.offset += RECORD.size + len(sentence)
+        self.log.write(''.join(records))
+        self.log.flush()
+        self.sentences += len(sentences)
+
+    def close(self):
+        self.log.close()
+        self.index.close()
+
+    def __str__(self):
+        return "Recorder %s: %d sentences, %d bytes" % (self.path, self.sentences, self.offset)
+
+
+class LogReader(object):
+    """
+    Reads a recorded log through a memory map
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.log_file = open(path, 'rb')
+        self.size = os.fstat(self.log_file.fileno()).st_size
+        self.log = None
+        if self.size:
+            self.log = mmap.mmap(self.log_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index = ''
+        if os.path.exists(path + '.idx'):
+            with open(path + '.idx', 'rb') as index_file:
+                index_size = os.fstat(index_file.fileno()).st_size
+                if index_size >= INDEX_ENTRY.size:
+                    self.index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.entries = len(self.index) // INDEX_ENTRY.size
+
+    def index_entry(self, i):
+        return INDEX_ENTRY.unpack_from(self.index, i * INDEX_ENTRY.size)
+
+    def first_time(self):
+        if not self.size:
+            return None
+        return RECORD.unpack_from(self.log, 0)[0]
+
+    def seek(self, timestamp):
+        """
+        Return the offset of the first record at or after timestamp
+        """
+
+        # binary search the index for the last entry at or before timestamp
+        lo, hi = 0, self.entries
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.index_entry(mid)[0] <= timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        offset = 0
+        if lo > 0:
+            offset = self.index_entry(lo - 1)[1]
+        # and walk forward from there
+        for record_offset, t, sentence in self.records(offset):
+            if t >= timestamp:
+                return record_offset
+        return self.size
+
+    def records(self, offset=0):
+        """
+        Generate (offset, time, sentence) for each record from offset
+        """
+
+        log = self.log
+        while offset + RECORD.size <= self.size:
+            t, length = RECORD.unpack_from(log, offset)
+            start = offset + RECORD.size
+            if start + length > self.size:
+                # the recorder was stopped part way through a record
+                return
+            yield offset, t, log[start:start + length]
+            offset = start + length
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+        if self.index:
+            self.index.close()
+        self.log_file.close()
+
+
+def replay(reader, out, speed=1.0, start=None):
+    """
+    Write the recorded sentences to out, keeping the recorded intervals
+    between them divided by speed
+    """
+
+    offset = 0
+    if start is not None:
+        offset = reader.seek(start)
+    first = None
+    began = time.time()
+    batch = []
+    batch_time = None
+    for record_offset, t, sentence in reader.records(offset):
+        if t != batch_time and batch:
+            out.write(''.join(batch))
+            out.flush()
+            batch = []
+        if t != batch_time:
+            if first is None:
+                first = t
+            delay = (t - first) / speed - (time.time() - began)
+            if delay > 0:
+                time.sleep(delay)
+            batch_time = t
+        batch.append(sentence)
+    if batch:
+        out.write(''.join(batch))
+        out.flush()
+
+
+def parse_start(value, reader):
+    """
+    A start time is either an ISO time in UTC, e.g. 2019-05-14T20:15:00,
+    or a number of seconds from the beginning of the recording
+    """
+
+    if 'T' in value:
+        start = dt.strptime(value, '%Y-%m-%dT%H:%M:%S')
+        return calendar.timegm(start.timetuple())
+    return reader.first_time() + float(value)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Replay a recorded NMEA stream')
+    subparsers = parser.add_subparsers(dest='command')
+    replay_parser = subparsers.add_parser('replay', help='write the recorded sentences to stdout')
+    replay_parser.add_argument('log', help='log recorded with server.py --record')
+    replay_parser.add_argument('-x', '--speed', type=float, default=1.0, help='replay speed, e.g. 10 for 10x')
+    replay_parser.add_argument('-s', '--start', help='where to start: seconds from the beginning of the '
+                                                     'recording or a UTC time such as 2019-05-14T20:15:00')
+    info_parser = subparsers.add_parser('info', help='describe a log')
+    info_parser.add_argument('log', help='log recorded with server.py --record')
+    args = parser.parse_args()
+
+    reader = LogReader(args.log)
+    if reader.first_time() is None:
+        print >>sys.stderr, "%s is empty" % args.log
+        sys.exit(1)
+
+    if args.command == 'info':
+        last = None
+        count = 0
+        for offset, t, sentence in reader.records():
+            last = t
+            count += 1
+        first = reader.first_time()
+        print "%s: %d sentences, %d bytes, %d index entries" % (args.log, count, reader.size, reader.entries)
+        print "from %s to %s UTC (%.0f seconds)" % (dt.utcfromtimestamp(first), dt.utcfromtimestamp(last), last - first)
+    else:
+        start = None
+        if args.start:
+            start = parse_start(args.start, reader)
+        try:
+            replay(reader, sys.stdout, args.speed, start)
+        except (IOError, KeyboardInterrupt):
+            # the reader has gone away
+            pass
+    reader.close()
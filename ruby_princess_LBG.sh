@@ -1,3 +1,4 @@
 #!/bin/bash
 
-./follow_route.py  -m 503633801 -n "RUBY PRINCESS" -s 14.0 -f ./lbg_route.json > ./nmea_fifo
+[ -p ./ruby_princess_fifo ] || mkfifo ./ruby_princess_fifo
+./follow_route.py  -m 503633801 -n "RUBY PRINCESS" -s 14.0 -f ./lbg_route.json > ./ruby_princess_fifo
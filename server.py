@@ -1,111 +1,1038 @@
 #!/usr/bin/env python
+import errno
 import select
+import signal
 import socket
 import sys
-import Queue
 import time
 import argparse
+from cpa import CPAMonitor
+from geo import AreaIndex
+from ingest import DuplicateFilter, LatestState, SentenceValidator
+from latency import Histogram, Tracer, monotonic
+from metrics import Metrics, StatsServer
+from nmea import SentenceParser
+from recorder import Recorder
+from sources import PipeSource, connect_sources, open_source, reopen_sources
+from workers import listen_shared, run_ingest, start_workers
+from uplink import UplinkEncoder
+from subscriptions import Decimator, PriorityLanes, Subscription, SubscriptionError, parse_intervals
+
+
+class SentenceRing(object):
+    """
+    Bounded ring of the most recently received NMEA sentences.
+
+    Each sentence is parsed once as it is stored and the resulting
+    SentenceInfo is kept alongside it, tagged with the subscribed areas
+    the vessel of an AIS sentence is in.
+
+    Each sentence is stored exactly once no matter how many clients are
+    connected. Sentences are numbered with an ever increasing sequence number
+    and every client keeps only a cursor: the sequence number of the next
+    sentence it has to send. When a client falls more than ``capacity``
+    sentences behind, the sentences it missed have been overwritten and are
+    lost to that client.
+    """
+
+    def __init__(self, capacity, lanes=None):
+        if capacity < 1:
+            raise ValueError("Ring capacity must be at least 1")
+        self.capacity = capacity
+        self.sentences = [None] * capacity
+        self.infos = [None] * capacity
+        self.parser = SentenceParser()
+        self.areas = AreaIndex()
+        # PriorityLanes, or None if every sentence has the same priority
+        self.lanes = lanes
+        # time each sentence arrived, from the monotonic clock like every
+        # deadline computed from it, so that a step of the system clock
+        # (NTP or the GPS setting it after boot) cannot hold sentences back
+        self.times = [0.0] * capacity
+        # bytes stored in the ring before each sentence, so the size of any
+        # run of sentences is a single subtraction
+        self.offsets = [0] * capacity
+        # sequence number that will be given to the next sentence stored
+        self.head = 0
+        self.total_bytes = 0
+
+    def append(self, sentence, now):
+        i = self.head % self.capacity
+        self.sentences[i] = sentence
+        info = self.infos[i] = self.parser.parse(sentence)
+        self.areas.update(info, now)
+        if self.lanes is not None:
+            info.lane = self.lanes.lane(info.address)
+        self.times[i] = now
+        self.offsets[i] = self.total_bytes
+        self.total_bytes += len(sentence)
+        self.head += 1
+
+    def extend(self, sentences, now):
+        for sentence in sentences:
+            self.append(sentence, now)
+
+    def tail(self):
+        # sequence number of the oldest sentence still held in the ring
+        return max(0, self.head - self.capacity)
+
+    def get(self, seq):
+        return self.sentences[seq % self.capacity]
+
+    def info(self, seq):
+        return self.infos[seq % self.capacity]
+
+    def time(self, seq):
+        return self.times[seq % self.capacity]
+
+    def offset(self, seq):
+        # bytes stored before sentence seq, for seq in tail() .. head
+        if seq == self.head:
+            return self.total_bytes
+        return self.offsets[seq % self.capacity]
+
+    def __len__(self):
+        return self.head - self.tail()
+
+
+class Client(object):
+    """
+    A connected TCP client reading from the shared ring
+    """
+
+    def __init__(self, sock, address, cursor, intervals=None, areas=None):
+        self.sock = sock
+        self.address = address
+        # sequence number of the next sentence to send to this client
+        self.cursor = cursor
+        # while set, sentences from this sequence number on are being
+        # dropped because the client's backlog was full (drop-newest policy)
+        self.hold = None
+        # sentences skipped because the client fell too far behind
+        self.dropped_oldest = 0
+        self.dropped_newest = 0
+        # with priority lanes, the cursor of each lane (cursor is the lowest
+        # of them), and how old lower priority sentences may be before they
+        # are dropped
+        self.lane_cursors = None
+        self.stale_after = None
+        self.dropped_stale = 0
+        # sentences this client asked for, None for all of them
+        self.subscription = None
+        # AreaIndex holding the areas of geographic subscriptions
+        self.areas = areas
+        # server wide decimation intervals, and the decimator applying them
+        # together with any the client asked for
+        self.intervals = intervals or {}
+        self.decimator = None
+        if self.intervals:
+            self.decimator = Decimator(self.intervals)
+        # partial subscription request
+        self.request = ''
+        # limits on this client's backlog, None for the server's default
+        self.policy = None
+        # sentences taken from the ring but not yet completely written.
+        # A send may accept only part of the buffer, so keep track of how far
+        # we got and resume from there on the next wakeup
+        self.outbuf = ''
+        self.offset = 0
+        # function returning the latest state for a subscription, to be
+        # sent first, and the time to send it if no subscription comes
+        self.snapshot = None
+        self.snapshot_due = None
+        # with tracing, the times the sampled sentences in the output buffer
+        # were stored in the ring, and the delays until they were sent
+        self.tracer = None
+        self.traced = []
+        self.latency = None
+        self.sends = 0
+        self.bytes_sent = 0
+        # recent bytes per second, and bytes_sent when it was last updated
+        self.send_rate = None
+        self.rate_mark = 0
+
+    def end(self, ring):
+        # sequence number after the last sentence this client will be sent
+        if self.hold is not None:
+            return self.hold
+        return ring.head
+
+    def pending(self, ring):
+        """
+        Return the number of sentences waiting to be sent to this client.
+        Sentences overwritten in the ring since the last call, or arrived
+        while a full backlog was being held, are counted as dropped and
+        skipped.
+        """
+
+        tail = ring.tail()
+        if self.cursor < tail:
+            self.dropped_oldest += tail - self.cursor
+            self.cursor = tail
+        if self.hold is not None and self.cursor >= self.hold:
+            # the held backlog has been sent, resume with current sentences
+            self.dropped_newest += ring.head - self.hold
+            self.cursor = ring.head
+            self.hold = None
+        return self.end(ring) - self.cursor
+
+    def pending_bytes(self, ring):
+        self.pending(ring)
+        return ring.offset(self.end(ring)) - ring.offset(self.cursor)
+
+    def unsent(self):
+        # bytes already taken from the ring that are still to be written
+        return len(self.outbuf) - self.offset
+
+    def deadline(self, ring, max_delay):
+        """
+        Return the time by which pending sentences must be sent, or None if
+        nothing is waiting for this client
+        """
+
+        if self.unsent():
+            return 0.0
+        if self.snapshot is not None:
+            return self.snapshot_due
+        due = None
+        if self.decimator is not None:
+            due = self.decimator.next_due()
+        if self.pending(ring) == 0:
+            return due
+        deadline = ring.time(self.cursor) + max_delay
+        if due is not None and due < deadline:
+            return due
+        return deadline
+
+    def ready(self, ring, now, max_bytes, max_delay):
+        """
+        Return True when it is time to write to this client: either a full
+        batch is waiting or the oldest waiting sentence has used up the
+        latency budget
+        """
+
+        deadline = self.deadline(ring, max_delay)
+        if deadline is None:
+            return False
+        if self.snapshot is not None:
+            # everything else waits for the snapshot
+            return deadline <= now
+        return deadline <= now or self.pending_bytes(ring) >= max_bytes
+
+    def gather(self, ring, max_bytes, now):
+        """
+        Take the pending sentences for this client, up to max_bytes, from
+        the ring. Returns the sentences and their SentenceInfos (None for
+        sentences released by the decimator).
+        """
+
+        self.pending(ring)
+        batch = []
+        infos = []
+        size = 0
+        decimator = self.decimator
+        if decimator is not None:
+            batch = decimator.flush(now)
+            infos = [None] * len(batch)
+            size = sum(len(sentence) for sentence in batch)
+        end = self.end(ring)
+        cursors = self.lane_cursors
+        if cursors is None:
+            self.cursor, size = self.take(ring, self.cursor, end, None, batch, infos, size, max_bytes, now)
+        else:
+            # higher priority lanes are drained first, the others get
+            # whatever room is left
+            for lane in range(len(cursors)):
+                # catch up with sentences dropped by the slow consumer policy
+                cursors[lane] = max(cursors[lane], self.cursor)
+                if size < max_bytes:
+                    cursors[lane], size = self.take(ring, cursors[lane], end, lane, batch, infos, size,
+                                                    max_bytes, now)
+            self.cursor = min(cursors)
+        return batch, infos
+
+    def take(self, ring, seq, end, lane, batch, infos, size, max_bytes, now):
+        """
+        Add the sentences for this client (in lane, if not None) from seq
+        on to batch, until end or max_bytes. Returns the sequence number
+        reached and the size of the batch.
+        """
+
+        subscription = self.subscription
+        decimator = self.decimator
+        tracer = self.tracer
+        stale = None
+        if lane and self.stale_after is not None:
+            stale = now - self.stale_after
+        while seq < end and size < max_bytes:
+            info = ring.info(seq)
+            if (lane is None or info.lane == lane) and (subscription is None or subscription.matches(info)):
+                sentence = ring.get(seq)
+                if stale is not None and ring.time(seq) < stale:
+                    self.dropped_stale += 1
+                elif decimator is None or decimator.offer(info.address, sentence, now):
+                    batch.append(sentence)
+                    infos.append(info)
+                    size += len(sentence)
+                    if tracer is not None and tracer.sampled(seq) and seq in tracer.enqueued:
+                        self.traced.append(tracer.enqueued[seq])
+            seq += 1
+        return seq, size
+
+    def use_lanes(self, count, stale_after=None):
+        self.lane_cursors = [self.cursor] * count
+        self.stale_after = stale_after
+
+    def prime(self, snapshot, due):
+        """
+        Start the output with the sentences snapshot(subscription) returns,
+        e.g. the latest state. They are sent as soon as the client has
+        subscribed, so that they follow the subscription, or at due if it
+        has not.
+        """
+
+        self.snapshot = snapshot
+        self.snapshot_due = due
+
+    def fill(self, ring, max_bytes, now):
+        """
+        Gather the pending sentences, up to max_bytes, into a single output
+        buffer. Nothing is gathered until a partial write has been completed.
+        """
+
+        if self.unsent():
+            return
+        if self.snapshot is not None:
+            if now < self.snapshot_due:
+                return
+            self.outbuf = ''.join(self.snapshot(self.subscription))
+            self.offset = 0
+            self.snapshot = None
+            return
+        batch, infos = self.gather(ring, max_bytes, now)
+        self.outbuf = ''.join(batch)
+        self.offset = 0
+
+    def send(self):
+        """
+        Write as much of the output buffer as the socket will take.
+        Raises socket.error if the connection has failed.
+        """
+
+        try:
+            sent = self.sock.send(buffer(self.outbuf, self.offset))
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            raise
+        self.offset += sent
+        self.sends += 1
+        self.bytes_sent += sent
+        if self.offset == len(self.outbuf):
+            self.outbuf = ''
+            self.offset = 0
+            if self.traced:
+                now = monotonic()
+                for enqueued in self.traced:
+                    self.latency.record(now - enqueued)
+                self.traced = []
+        return sent
+
+    def trace(self, tracer):
+        self.tracer = tracer
+        self.latency = Histogram()
+
+    def receive(self):
+        """
+        Read subscription requests from the client. Returns False if the
+        client has closed the connection or sent anything else.
+        """
+
+        try:
+            data = self.sock.recv(4096)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return True
+            return False
+        if len(data) == 0:
+            return False
+        self.request += data
+        while '\n' in self.request:
+            line, self.request = self.request.split('\n', 1)
+            if not line.strip():
+                continue
+            try:
+                subscription = Subscription.parse(line)
+            except SubscriptionError:
+                return False
+            self.unsubscribe()
+            self.subscription = subscription
+            if subscription.area is not None:
+                self.areas.add(subscription.area)
+            intervals = dict(self.intervals)
+            intervals.update(self.subscription.intervals)
+            self.decimator = None
+            if intervals:
+                self.decimator = Decimator(intervals)
+            if self.snapshot is not None:
+                # no need to wait any longer
+                self.snapshot_due = 0.0
+        # no request is this long
+        return len(self.request) < 1024
+
+    def unsubscribe(self):
+        if self.subscription is not None and self.subscription.area is not None:
+            self.areas.remove(self.subscription.area)
+        self.subscription = None
+
+    def stats(self, ring):
+        text = "%s: %d sentences (%d bytes) behind, %d bytes in %d sends, dropped %d oldest %d newest %d stale" % \
+            (self, self.pending(ring), self.pending_bytes(ring) + self.unsent(), self.bytes_sent,
+             self.sends, self.dropped_oldest, self.dropped_newest, self.dropped_stale)
+        if self.latency is not None:
+            text += "\n    ring to socket: %s" % self.latency
+        return text
+
+    def __str__(self):
+        return "Client %s:%s" % self.address
+
+
+class UplinkClient(Client):
+    """
+    A shore station on an expensive link: sentences are sent in batches,
+    one every window seconds, compressed by an UplinkEncoder
+    """
+
+    def __init__(self, sock, address, cursor, window=5.0, intervals=None, areas=None):
+        super(UplinkClient, self).__init__(sock, address, cursor, intervals, areas)
+        self.window = window
+        self.encoder = UplinkEncoder()
+
+    def deadline(self, ring, max_delay):
+        return super(UplinkClient, self).deadline(ring, self.window)
+
+    def ready(self, ring, now, max_bytes, max_delay):
+        deadline = self.deadline(ring, max_delay)
+        return deadline is not None and deadline <= now
+
+    def prime(self, snapshot, due):
+        # the shore station gets the whole snapshot in its first window
+        self.outbuf = self.encoder.encode(snapshot(None))
+        self.offset = 0
+
+    def fill(self, ring, max_bytes, now):
+        if self.unsent():
+            return
+        # the whole window goes in one batch
+        batch, infos = self.gather(ring, ring.total_bytes, now)
+        if batch:
+            self.outbuf = self.encoder.encode(batch, infos)
+            self.offset = 0
+
+    def stats(self, ring):
+        return "%s, %s" % (super(UplinkClient, self).stats(ring), self.encoder)
+
+    def __str__(self):
+        return "Uplink %s:%s" % self.address
+
+
+class SlowConsumerPolicy(object):
+    """
+    Limits how far any one client may fall behind the incoming sentences,
+    so that a slow or sleeping client cannot hold on to memory or stale data.
+
+    policy is one of
+    - 'drop-oldest': skip the oldest waiting sentences to get back within the limits
+    - 'drop-newest': send the waiting sentences that fit within the limits and
+      drop whatever arrives until they have gone
+    - 'disconnect': close the connection once the oldest waiting sentence
+      is more than max_behind seconds old
+    """
+
+    POLICIES = ('drop-oldest', 'drop-newest', 'disconnect')
+
+    def __init__(self, policy='drop-oldest', max_sentences=1024, max_bytes=65536, max_behind=30.0):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown slow consumer policy %s" % policy)
+        self.policy = policy
+        self.max_sentences = max_sentences
+        self.max_bytes = max_bytes
+        self.max_behind = max_behind
+
+    def within_limits(self, ring, start, end):
+        return end - start <= self.max_sentences and \
+            ring.offset(end) - ring.offset(start) <= self.max_bytes
+
+    def apply(self, client, ring, now):
+        """
+        Bring the client back within the limits.
+        Returns False if the client should be disconnected.
+        """
+
+        if client.pending(ring) == 0:
+            return True
+        if self.policy == 'disconnect':
+            return now - ring.time(client.cursor) <= self.max_behind
+        end = client.end(ring)
+        if self.within_limits(ring, client.cursor, end):
+            return True
+        if self.policy == 'drop-oldest':
+            # find the oldest sentence we can keep
+            lo, hi = client.cursor, end
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.within_limits(ring, mid, end):
+                    hi = mid
+                else:
+                    lo = mid + 1
+            client.dropped_oldest += lo - client.cursor
+            client.cursor = lo
+        else:
+            # find the newest sentence we can keep
+            lo, hi = client.cursor, end
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if self.within_limits(ring, client.cursor, mid):
+                    lo = mid
+                else:
+                    hi = mid - 1
+            client.hold = lo
+        return True
+
+
+class DatagramOutput(object):
+    """
+    Sends every sentence once to a LAN broadcast or multicast address, so
+    the cost of distribution does not depend on the number of listeners.
+    Sentences are packed into datagrams of at most mtu bytes.
+    """
+
+    def __init__(self, address, port, mtu=1472, cursor=0):
+        self.address = (address, port)
+        # resolved once, so a host name costs no lookup for every datagram
+        self.destination = (socket.gethostbyname(address), port)
+        self.mtu = mtu
+        self.cursor = cursor
+        self.datagrams = 0
+        self.dropped = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        if 224 <= int(self.destination[0].split('.')[0]) <= 239:
+            # keep multicast on the boat's own network
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        self.sock.setblocking(0)
+
+    def flush(self, ring):
+        """
+        Send everything that has arrived since the last flush
+        """
+
+        tail = ring.tail()
+        if self.cursor < tail:
+            self.dropped += tail - self.cursor
+            self.cursor = tail
+        while self.cursor < ring.head:
+            batch = []
+            size = 0
+            seq = self.cursor
+            while seq < ring.head:
+                sentence = ring.get(seq)
+                if batch and size + len(sentence) > self.mtu:
+                    break
+                batch.append(sentence)
+                size += len(sentence)
+                seq += 1
+            try:
+                self.sock.sendto(''.join(batch), self.destination)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                    # try again after the next select
+                    return
+                # the network has gone away, this batch is lost
+                self.dropped += seq - self.cursor
+            else:
+                self.datagrams += 1
+            self.cursor = seq
+
+    def __str__(self):
+        return "UDP output %s:%s" % self.address
 
 
 parser = argparse.ArgumentParser("Read NMEA sentence from FIFO and distribute to TCP clients")
 parser.add_argument('-f', '--fifo', default='./nmea_fifo', help='path to NMEA input FIFO')
+parser.add_argument('-s', '--source', action='append', default=[],
+                    help='NMEA source as [tag=]kind:address, e.g. fifo:./nmea_fifo, serial:/dev/ttyUSB0:38400, '
+                         'udp:10110 or tcp:host:port. May be repeated; defaults to the FIFO given by --fifo')
 parser.add_argument('-p', '--port', default=10000, type=int, help='TCP port for client connections')
+parser.add_argument('-r', '--ring-size', default=4096, type=int,
+                    help='number of recent sentences held for distribution to clients')
+parser.add_argument('--batch-bytes', default=8192, type=int,
+                    help='maximum bytes gathered into a single send to a client')
+parser.add_argument('--batch-delay', default=0.0, type=float,
+                    help='milliseconds a sentence may be held back to coalesce it with later sentences')
+parser.add_argument('--slow-policy', default='drop-oldest', choices=SlowConsumerPolicy.POLICIES,
+                    help='what to do with a client that falls too far behind')
+parser.add_argument('--client-max-sentences', default=1024, type=int,
+                    help='maximum sentences waiting for any one client')
+parser.add_argument('--client-max-bytes', default=65536, type=int,
+                    help='maximum bytes waiting for any one client')
+parser.add_argument('--client-max-behind', default=30.0, type=float,
+                    help='seconds a client may fall behind before it is disconnected (disconnect policy)')
+parser.add_argument('--lane', default=[], action='append', metavar='ADDRESSES',
+                    help='sentence addresses and talkers, e.g. AI,GP, sent ahead of everything in later lanes '
+                         'and sentences in no lane (may be repeated, highest priority first)')
+parser.add_argument('--stale-after', default=10.0, type=float,
+                    help='seconds after which sentences below the first lane are dropped rather than sent '
+                         'to a client that has fallen behind (0 never)')
+parser.add_argument('--send-buffer', default=0, type=int, metavar='BYTES',
+                    help='kernel send buffer size for client sockets, small to keep a congested client\'s backlog '
+                         'in the server where it can be prioritised (0 for the system default)')
+parser.add_argument('-d', '--decimate', action='append', default=[],
+                    help='send each client at most one sentence with this address (or formatter) per interval, '
+                         'given as address:seconds, e.g. HDT:1. May be repeated')
+parser.add_argument('--no-validate', action='store_true',
+                    help='pass on sentences without checking their framing and checksum')
+parser.add_argument('--max-length', default=82, type=int,
+                    help='longest valid sentence, including the line ending')
+parser.add_argument('--quarantine', help='append rejected sentences to this file')
+parser.add_argument('--dedup-window', default=0.0, type=float,
+                    help='drop AIS sentences already received within this many seconds, e.g. from a second '
+                         'receiver (0 to keep them all)')
+parser.add_argument('--dedup-size', default=4096, type=int,
+                    help='maximum number of recent AIS sentences remembered for duplicate detection')
+parser.add_argument('--cpa', default=0.0, type=float,
+                    help='raise ALR alarms for vessels that will pass closer than this many nm (0 to disable)')
+parser.add_argument('--cpa-time', default=10.0, type=float,
+                    help='minutes ahead to look for close approaches')
+parser.add_argument('--cpa-range', default=4.0, type=float,
+                    help='nm within which vessels are compared for close approaches')
+parser.add_argument('--snapshot-age', default=600.0, type=float,
+                    help='send new clients the latest sentences for each vessel and instrument heard within '
+                         'this many seconds (0 to disable)')
+parser.add_argument('--snapshot-wait', default=0.25, type=float,
+                    help='seconds to wait for a new client to subscribe before sending it the snapshot unfiltered')
+parser.add_argument('--record', help='append every sentence distributed, with its arrival time, to this log '
+                                     '(replay it with recorder.py)')
+parser.add_argument('--stats-port', default=0, type=int,
+                    help='TCP port serving live metrics in Prometheus text format (0 to disable)')
+parser.add_argument('--uplink-port', default=0, type=int,
+                    help='TCP port for shore stations, which get compressed batches of sentences (0 to disable)')
+parser.add_argument('--uplink-window', default=5.0, type=float,
+                    help='seconds of sentences sent in each batch on the uplink')
+parser.add_argument('-u', '--udp-out', action='append', default=[],
+                    help='also send every sentence to a broadcast or multicast address:port, '
+                         'e.g. 192.168.1.255:10110. May be repeated')
+parser.add_argument('--udp-mtu', default=1472, type=int,
+                    help='maximum size of a UDP datagram')
+parser.add_argument('--trace', default=0, type=int, metavar='N',
+                    help='measure the delays of one sentence in N from source to ring and ring to each client socket')
+parser.add_argument('-w', '--workers', default=1, type=int,
+                    help='number of worker processes sharing the client port, each serving some of the clients')
 args = parser.parse_args()
 
 
-nmea_fifo = open(args.fifo, "r", 0)
+if not args.source:
+    args.source = ['fifo:' + args.fifo]
+sources = [open_source(description, time.time()) for description in args.source]
+for source in sources:
+    if source.closed and not source.connecting:
+        print >>sys.stderr, "%s cannot be opened yet, retrying" % source
 
+# Ingest stages, applied to every batch read from a source
+validator = None
+if not args.no_validate:
+    validator = SentenceValidator(args.max_length, args.quarantine)
 
-# Create a TCP/IP socket
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server.setblocking(0)
+duplicates = None
+if args.dedup_window > 0:
+    duplicates = DuplicateFilter(args.dedup_window, args.dedup_size)
+
+recorder = None
+if args.record:
+    recorder = Recorder(args.record)
+
+cpa = None
+if args.cpa > 0:
+    cpa = CPAMonitor(args.cpa, args.cpa_time * 60.0, args.cpa_range)
+
+
+def ingest(sentences, now, tag):
+    if validator is not None:
+        sentences = validator.filter(sentences, tag)
+    if duplicates is not None:
+        sentences = duplicates.filter(sentences, now, tag)
+    if recorder is not None:
+        recorder.write(sentences, now)
+    # alarms are not recorded, a replay raises them again
+    if cpa is not None:
+        sentences = sentences + cpa.process(sentences, now)
+    return sentences
+
+
+# With several workers this process only reads the sources and feeds the
+# workers, which serve the clients
+worker = None
+if args.workers > 1:
+    worker, pipe = start_workers(args.workers)
+    if worker is None:
+        print >>sys.stderr, 'started %d workers' % args.workers
+        # the ingest process serves the counts of what it reads and of
+        # its stages on the stats port
+        metrics = Metrics()
 
-# Bind the socket to the port
+        def ingest_and_count(sentences, now, tag):
+            sentences = ingest(sentences, now, tag)
+            metrics.count(tag, sentences)
+            metrics.tick(now, ())
+            return sentences
+
+        stats_server = None
+        if args.stats_port:
+            stats_server = StatsServer(args.stats_port, lambda now: metrics.ingest_exposition(
+                now, pipe, duplicates, validator, cpa))
+        run_ingest(sources, pipe, ingest_and_count, stats_server)
+        sys.exit(0)
+    for source in sources:
+        if source.connecting:
+            source.discard()
+        elif not source.closed:
+            source.close()
+    sources = [PipeSource('worker %d' % worker, pipe)]
+    # the ingest process has already done these
+    validator = None
+    duplicates = None
+    recorder = None
+    cpa = None
+    # only one worker sends to the UDP outputs
+    if worker > 0:
+        args.udp_out = []
+    # and each worker serves its own metrics, on the ports after the
+    # ingest process's
+    if args.stats_port:
+        args.stats_port += worker + 1
+
+
+# Create a TCP/IP socket
 server_address = ('', args.port)
 print >>sys.stderr, 'starting up on %s port %s' % server_address
-server.bind(server_address)
+if worker is None:
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setblocking(0)
 
-# Listen for incoming connections
-server.listen(5)
+    # Bind the socket to the port
+    server.bind(server_address)
 
-# fifo  from which we expect to read
-inputs = [ server, nmea_fifo ]
-# inputs = [ server, nmea_fifo ]
+    # Listen for incoming connections
+    server.listen(5)
+else:
+    # all the workers listen on the same port
+    server = listen_shared(args.port)
+
+# sources from which we expect to read
+inputs = [ server ] + [source for source in sources if not source.closed]
+
+# Shore stations connect to the uplink port
+uplink_server = None
+if args.uplink_port:
+    if worker is None:
+        uplink_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        uplink_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        uplink_server.setblocking(0)
+        uplink_server.bind(('', args.uplink_port))
+        uplink_server.listen(5)
+    else:
+        uplink_server = listen_shared(args.uplink_port)
+    inputs.append(uplink_server)
+
+# Metrics are always collected, and served if a stats port is given
+metrics = Metrics()
+stats_server = None
 
 # Sockets to which we expect to write
 outputs = [ ]
 
-# Outgoing message queues (socket:Queue)
-message_queues = {}
+# Sentences shared by all clients
+lanes = None
+if args.lane:
+    lanes = PriorityLanes([lane.split(',') for lane in args.lane])
+ring = SentenceRing(args.ring_size, lanes)
+
+# Connected clients (socket:Client)
+clients = {}
+
+# Broadcast and multicast outputs
+udp_outputs = []
+for destination in args.udp_out:
+    address, port = destination.rsplit(':', 1)
+    udp_outputs.append(DatagramOutput(address, int(port), args.udp_mtu))
+
+batch_delay = args.batch_delay / 1000.0
+
+decimation_intervals = parse_intervals(args.decimate)
+
+# Latest state, sent to clients as they connect
+latest_state = None
+if args.snapshot_age > 0:
+    latest_state = LatestState(args.snapshot_age)
+
+# Latency tracing of a sample of the sentences
+tracer = None
+if args.trace > 0:
+    tracer = Tracer(args.trace)
+
+slow_policy = SlowConsumerPolicy(args.slow_policy, args.client_max_sentences,
+                                 args.client_max_bytes, args.client_max_behind)
+
+# an uplink may hold a whole window of sentences, and should not be cut off
+uplink_policy = SlowConsumerPolicy('drop-oldest', args.ring_size, 1 << 20)
+
+
+def dump_stats(signum, frame):
+    # kill -USR1 <pid> lists the clients and how well they are keeping up
+    print >>sys.stderr, "%d clients, %d sentences received" % (len(clients), ring.head)
+    for output in udp_outputs:
+        print >>sys.stderr, "  %s: %d datagrams, dropped %d" % (output, output.datagrams, output.dropped)
+    if validator is not None:
+        print >>sys.stderr, "  " + str(validator)
+    if duplicates is not None:
+        print >>sys.stderr, "  " + str(duplicates)
+    if latest_state is not None:
+        print >>sys.stderr, "  " + str(latest_state)
+    if recorder is not None:
+        print >>sys.stderr, "  " + str(recorder)
+    if cpa is not None:
+        print >>sys.stderr, "  " + str(cpa)
+    if tracer is not None:
+        print >>sys.stderr, "  Source to ring: %s" % tracer.ingest
+    print >>sys.stderr, "  " + str(ring.areas)
+    for client in clients.values():
+        print >>sys.stderr, "  " + client.stats(ring)
+
+signal.signal(signal.SIGUSR1, dump_stats)
+
+
+def exposition(now):
+    return metrics.exposition(now, ring, clients.values(), udp_outputs, duplicates, validator, tracer, cpa)
+
+if args.stats_port:
+    stats_server = StatsServer(args.stats_port, exposition)
+
+
+def close_client(s):
+    # print >>sys.stderr, "Closing client %s" % (clients[s])
+    inputs.remove(s)
+    if s in outputs:
+        outputs.remove(s)
+    if s in clients:
+        clients[s].unsubscribe()
+        del clients[s]
+    s.close()
+
+
+# Failed sources waiting to be reopened, and those still connecting
+reopening = [source for source in sources if source.closed]
+
+
+def close_source(source):
+    print >>sys.stderr, "%s has closed after %d sentences" % (source, source.sentences)
+    inputs.remove(source)
+    if not source.closed:
+        source.close()
+    if source.reopenable():
+        # the clients stay connected while the source is reopened
+        reopening.append(source)
+        return
+    sources.remove(source)
+    if not sources:
+        print >>sys.stderr, "No sources left"
+        sys.exit(0)
+
+
+def schedule_writes(now):
+    """
+    Start watching the clients that are ready to be written to, and return
+    the time until the next held back batch falls due (None if there is none)
+    """
+
+    timeout = None
+    for c, client in clients.items():
+        if not (client.policy or slow_policy).apply(client, ring, now):
+            print >>sys.stderr, "Disconnecting slow " + client.stats(ring)
+            close_client(c)
+            continue
+        if c in outputs:
+            continue
+        if client.ready(ring, now, args.batch_bytes, batch_delay):
+            outputs.append(c)
+            continue
+        deadline = client.deadline(ring, batch_delay)
+        if deadline is not None and (timeout is None or deadline - now < timeout):
+            timeout = max(0.0, deadline - now)
+    return timeout
+
 
 while inputs:
 
+    mark = time.time()
+    metrics.tick(mark, clients.values())
+
+    if udp_outputs:
+        for output in udp_outputs:
+            output.flush(ring)
+        now = time.time()
+        metrics.stage('udp_output', now - mark)
+        mark = now
+
+    timeout = schedule_writes(monotonic())
+    if reopening:
+        reopened, retry = reopen_sources(reopening, mark)
+        for source in reopened:
+            print >>sys.stderr, "%s has been reopened" % source
+            inputs.append(source)
+        if retry is not None and (timeout is None or retry < timeout):
+            timeout = retry
+    connecting = [source for source in reopening if source.connecting]
+    stats_readers = stats_writers = []
+    if stats_server is not None:
+        due = stats_server.schedule(mark)
+        if due is not None and (timeout is None or due < timeout):
+            timeout = due
+        stats_readers = stats_server.readers()
+        stats_writers = stats_server.writers()
+    now = time.time()
+    metrics.stage('schedule', now - mark)
+    mark = now
+
     # Wait for at least one of the sockets to be ready for processing
     # print >>sys.stderr, '\nwaiting for the next event'
-    readable, writeable, exceptional = select.select(inputs, outputs, inputs)
+    try:
+        readable, writeable, exceptional = select.select(inputs + stats_readers,
+                                                         outputs + stats_writers + connecting, inputs, timeout)
+    except select.error as e:
+        if e.args[0] == errno.EINTR:
+            # interrupted by a signal
+            continue
+        raise
+    now = time.time()
+    metrics.stage('select', now - mark)
+    started = mark = now
     # print "select returned, %d readable, %d writeable, %d exceptional\n" % (len(readable), len(writeable), len(exceptional))
 
     # process the readable files
 
     for s in readable:
-        if s is server:
+        if s is server or s is uplink_server:
 
-            # A "readable" server socket is ready to accept a connection
-            connection, client_address = s.accept()
+            # A "readable" server socket is ready to accept a connection,
+            # unless another worker took it or the client has already gone
+            try:
+                connection, client_address = s.accept()
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED):
+                    continue
+                raise
             # print >>sys.stderr, 'new connection from', client_address
             connection.setblocking(0)
-            outputs.append(connection)
+            if args.send_buffer:
+                connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, args.send_buffer)
             inputs.append(connection)
- 
-
-            # Give the connection a queue for data we want to send
-            message_queues[connection] = Queue.Queue()
-
-        elif s is nmea_fifo:
-            # print >>sys.stderr, 'Reading from fifo'
-            data = nmea_fifo.readline()
-            if len(data) == 0:
-                print >>sys.stderr, "No data read from fifo, must be closed"
-                sys.exit(0) 
-            # distribute msg to all queues
+
+            # New clients start with the next sentence to arrive
+            if s is server:
+                client = Client(connection, client_address, ring.head, decimation_intervals, ring.areas)
+            else:
+                client = UplinkClient(connection, client_address, ring.head, args.uplink_window,
+                                      decimation_intervals, ring.areas)
+                client.policy = uplink_policy
+            clients[connection] = client
+
+            # Bring the client up to date without waiting for the next reports
+            if latest_state is not None:
+                client.prime(lambda subscription: latest_state.snapshot(time.time(), subscription),
+                             monotonic() + args.snapshot_wait)
+            if tracer is not None:
+                client.trace(tracer)
+            if lanes is not None:
+                client.use_lanes(len(lanes), args.stale_after or None)
+            stage = 'accept'
+
+        elif s in stats_readers:
+            stats_server.read(s, time.time())
+            stage = 'accept'
+
+        elif s in sources:
+            # print >>sys.stderr, 'Reading from %s' % (s, )
+            # store the whole batch once for all clients, they are all
+            # woken up together before the next select
             # sys.stdout.write("read data: %s\n" % (data, ))
             # sys.stdout.flush()
-            for c in message_queues.keys():
-                message_queues[c].put(data) 
-                if c not in outputs:
-                    outputs.append(c)
-            if len(message_queues) == 0:
-                # print >> sys.stderr, "Discarding sentence, no readers"
-                pass
+            read_time = monotonic()
+            now = time.time()
+            sentences = ingest(s.read(), now, s.tag)
+            head = ring.head
+            ring.extend(sentences, read_time)
+            if tracer is not None:
+                tracer.enqueue(ring, head, read_time)
+            if latest_state is not None:
+                for seq in range(head, ring.head):
+                    latest_state.update(ring.get(seq), ring.info(seq), now)
+            metrics.ingest(s.tag, ring, head, ring.head)
+            if s.closed:
+                close_source(s)
+            stage = 'ingest'
 
         else:
-            # any input from a client should close the connection
-   
-            # print >>sys.stderr, "Closing client %s" % (s)
-            inputs.remove(s)
-            if s in outputs:
-                outputs.remove(s)
-            if s in message_queues:
-                del message_queues[s]
-            s.close()
+            # clients may send subscription requests, anything else closes
+            # the connection
+            if not clients[s].receive():
+                close_client(s)
+            stage = 'client_input'
+
+        now = time.time()
+        metrics.stage(stage, now - mark)
+        mark = now
 
     # Handle outputs
+    if connecting:
+        for source in connect_sources(reopening, writeable, time.time()):
+            print >>sys.stderr, "%s has connected" % source
+            inputs.append(source)
     for s in writeable:
-        try:
-            # print >>sys.stderr, "%s is writeables" % (s)
-            next_msg = message_queues[s].get_nowait()
-        except Queue.Empty:
+        if s in stats_writers:
+            stats_server.write(s)
+            continue
+        if s in connecting:
+            continue
+        if s not in clients:
+            # closed while processing the readable sockets
+            continue
+        client = clients[s]
+        client.fill(ring, args.batch_bytes, monotonic())
+        if not client.unsent():
             # No messages waiting so stop checking for writability.
             # print >>sys.stderr, 'output queue for', s.getpeername(), 'is empty'
             outputs.remove(s)
-        else:
-            # print >>sys.stderr, 'sending "%s" to %s' % (next_msg, s.getpeername())
-            s.send(next_msg)
+            continue
+        try:
+            # print >>sys.stderr, 'sending %d bytes to %s' % (client.unsent(), s.getpeername())
+            client.send()
+        except socket.error:
+            close_client(s)
+            continue
+        if not client.unsent() and not client.ready(ring, monotonic(), args.batch_bytes, batch_delay):
+            # wait for a full batch or for the latency budget to run out
+            outputs.remove(s)
+
+    if writeable:
+        now = time.time()
+        metrics.stage('write', now - mark)
+        mark = now
 
     # process exceptions
 
     for e in exceptional:
-        if e is nmea_fifo:
-            # fifo is close there are no more writers
-            print >> sys.stderr,  'fifo has closed there are no more writers'
-            sys.exit(1)
+        if e in sources and e in inputs:
+            # the source has failed, e.g. a fifo with no more writers
+            close_source(e)
+
+    metrics.iteration(time.time() - started)
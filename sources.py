@@ -0,0 +1,506 @@
+#!/usr/bin/env python
+
+"""
+NMEA input sources for the distribution server.
+
+Every source can be handed to select() and reads complete NMEA sentences
+into a list. Each source does its own line framing, so sentences from
+different sources can never be torn or interleaved.
+
+Sources are described on the command line as [tag=]kind:address
+
+    fifo:./nmea_fifo                named pipe
+    serial:/dev/ttyUSB0:38400       serial port (default 4800 baud)
+    udp:10110                       UDP listener, optionally udp:host:port
+    tcp:192.168.1.10:10110          TCP connection to an NMEA feed
+
+The tag names the source in log messages and defaults to the description.
+
+A source that fails or reaches end of file is reopened, retrying with
+exponential backoff, so that a restarted writer, a replugged serial
+adapter or a rebooted multiplexer does not take the server (and every
+client connection) down with it. A source that cannot be opened when the
+server starts is retried in the same way. A FIFO never reaches end of
+file: the source holds its own write end open, so writers can come and go
+and the next one is read as soon as it starts writing. TCP connections are
+made without blocking, the server carrying on while they are completed.
+"""
+
+import errno
+import fcntl
+import io
+import os
+import socket
+import termios
+
+
+class LineBuffer(object):
+    """
+    Reassemble complete lines from data that arrives in arbitrary chunks.
+
+    Data is read straight into one reusable buffer, complete lines are split
+    out of it and a partial line at the end is moved to the front of the
+    buffer to be completed by the next read.
+    """
+
+    def __init__(self, size=65536, resync=False):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        # number of bytes held in the buffer
+        self.end = 0
+        # times the buffer filled up without a line end
+        self.overflows = 0
+        # with resync, a line holding a sentence start ($ or !) after its
+        # first character is cut to begin there: what came before it is
+        # what remained of a sentence whose writer went away
+        self.resync = resync
+        self.torn = 0
+
+    def fill(self, readinto):
+        """
+        Read into the free end of the buffer with readinto(view), which
+        returns the number of bytes read, 0 at end of file or None if
+        nothing is available
+        """
+
+        if self.end == len(self.buf):
+            # no NMEA sentence is this long, throw the junk away
+            self.overflows += 1
+            self.end = 0
+        n = readinto(self.view[self.end:])
+        if n:
+            self.end += n
+        return n
+
+    def lines(self):
+        """
+        Return the complete lines in the buffer, keeping any partial line
+        """
+
+        buf = self.buf
+        lines = []
+        start = 0
+        while True:
+            nl = buf.find('\n', start, self.end)
+            if nl < 0:
+                break
+            if self.resync:
+                begin = max(buf.rfind('$', start + 1, nl), buf.rfind('!', start + 1, nl))
+                if begin > 0:
+                    self.torn += 1
+                    start = begin
+            lines.append(str(buf[start:nl + 1]))
+            start = nl + 1
+        if start:
+            remaining = self.end - start
+            buf[:remaining] = buf[start:self.end]
+            self.end = remaining
+        return lines
+
+
+class Source(object):
+    """
+    Base class for NMEA sources.
+    Sub-classes set self.fd and implement read(), and those that can be
+    reopened after failing implement open(), and connected() if opening
+    completes in the background
+    """
+
+    # seconds between attempts to reopen, doubling up to the maximum
+    min_backoff = 0.1
+    max_backoff = 30.0
+    # seconds allowed for a connection to be made
+    connect_timeout = 2.0
+
+    def __init__(self, tag):
+        self.tag = tag
+        self.fd = None
+        self.closed = False
+        # waiting for select to find the source writable, see connected()
+        self.connecting = False
+        self.started = False
+        self.sentences = 0
+        self.reopens = 0
+        self.backoff = self.min_backoff
+        self.next_attempt = 0.0
+
+    def fileno(self):
+        return self.fd
+
+    def open(self):
+        """
+        (Re)open the underlying device, raising an EnvironmentError (or a
+        termios.error) on failure and leaving nothing open. A source that
+        is still connecting when this returns sets self.connecting
+        """
+        raise NotImplementedError
+
+    def connected(self, now):
+        """
+        Finish opening a connecting source that select found writable.
+        Returns True if the source is open, otherwise it is retried later
+        """
+        raise NotImplementedError
+
+    def reopenable(self):
+        # compare the functions, each access to a method makes a new
+        # method object
+        return self.open.__func__ is not Source.__dict__['open']
+
+    def start(self, now):
+        """
+        Open a reopenable source for the first time. One that cannot be
+        opened is left closed, to be retried by reopen() like a source
+        that has failed. Returns True if the source is open.
+        """
+
+        self.closed = True
+        return self.attempt(now)
+
+    def reopen(self, now):
+        """
+        Try to reopen a closed source, if the backoff allows, or give up on
+        a connection that has not been made in time. Returns True if the
+        source is open again.
+        """
+
+        if now < self.next_attempt:
+            return False
+        if self.connecting:
+            self.connecting = False
+            self.discard()
+            self.failed(now)
+            return False
+        return self.attempt(now)
+
+    def attempt(self, now):
+        try:
+            self.open()
+        except (EnvironmentError, termios.error):
+            self.failed(now)
+            return False
+        if self.connecting:
+            self.next_attempt = now + self.connect_timeout
+            return False
+        self.opened()
+        return True
+
+    def opened(self):
+        if self.started:
+            self.reopens += 1
+        self.started = True
+        self.closed = False
+        self.backoff = self.min_backoff
+
+    def failed(self, now):
+        self.next_attempt = now + self.backoff
+        self.backoff = min(self.backoff * 2, self.max_backoff)
+
+    def discard(self):
+        """
+        Release what open() opened without counting the source as failed
+        """
+        raise NotImplementedError
+
+    def read(self):
+        """
+        Return a list of the complete sentences now available. If the source
+        has gone away, sets self.closed and returns an empty list.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        self.closed = True
+
+    def __str__(self):
+        return "Source %s" % self.tag
+
+
+class StreamSource(Source):
+    """
+    Source read in large chunks from a non-blocking file descriptor or socket.
+
+    Each wakeup drains whatever is waiting (up to max_reads reads, so one
+    busy source cannot starve the others) and returns every complete line
+    in one batch.
+    """
+
+    max_reads = 8
+
+    def __init__(self, tag):
+        super(StreamSource, self).__init__(tag)
+        self.lines = LineBuffer()
+
+    def opened(self):
+        super(StreamSource, self).opened()
+        # the end of a sentence torn by the failure is not coming
+        self.lines.end = 0
+
+    def set_nonblocking(self):
+        flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.file = io.open(self.fd, 'rb', buffering=0, closefd=False)
+
+    def readinto(self, view):
+        return self.file.readinto(view)
+
+    def read(self):
+        lines = []
+        for i in range(self.max_reads):
+            try:
+                n = self.lines.fill(self.readinto)
+            except (IOError, OSError, socket.error) as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                self.close()
+                break
+            if n is None:
+                # nothing more waiting
+                break
+            if n == 0:
+                # no more writers
+                self.close()
+                break
+            # make room for the next read
+            lines.extend(self.lines.lines())
+        lines.extend(self.lines.lines())
+        self.sentences += len(lines)
+        return lines
+
+
+class FifoSource(StreamSource):
+    """
+    Named pipe written to by another process, e.g. follow_route.py
+
+    As the FIFO never reaches end of file, the partial sentence left by a
+    writer that dies mid-line would be joined to the start of the next
+    writer's data; the line buffer drops such a fragment instead.
+    """
+
+    def __init__(self, tag, path):
+        super(FifoSource, self).__init__(tag)
+        self.lines.resync = True
+        self.path = path
+        self.keeper = None
+
+    def open(self):
+        self.fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            # with a writer of our own the FIFO never reaches end of file
+            # when the real writers close it
+            self.keeper = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+            self.set_nonblocking()
+        except EnvironmentError:
+            self.discard()
+            raise
+
+    def discard(self):
+        os.close(self.fd)
+        if self.keeper is not None:
+            os.close(self.keeper)
+            self.keeper = None
+
+    def close(self):
+        super(FifoSource, self).close()
+        self.discard()
+
+
+class PipeSource(StreamSource):
+    """
+    Read end of a pipe, e.g. from the ingest process to a worker
+    """
+
+    def __init__(self, tag, fd):
+        super(PipeSource, self).__init__(tag)
+        self.fd = fd
+        self.set_nonblocking()
+
+    def close(self):
+        super(PipeSource, self).close()
+        os.close(self.fd)
+
+
+class SerialSource(StreamSource):
+    """
+    Serial port (GPS, AIS receiver, instruments) in raw mode
+    """
+
+    def __init__(self, tag, device, baud=4800):
+        super(SerialSource, self).__init__(tag)
+        self.device = device
+        self.speed = getattr(termios, 'B%d' % baud, None)
+        if self.speed is None:
+            raise ValueError("Unsupported baud rate %d" % baud)
+
+    def open(self):
+        speed = self.speed
+        self.fd = os.open(self.device, os.O_RDONLY | os.O_NOCTTY | os.O_NONBLOCK)
+        try:
+            self.set_nonblocking()
+            # raw 8N1, no echo, no line editing
+            iflag, oflag, cflag, lflag, ispeed, ospeed, cc = termios.tcgetattr(self.fd)
+            iflag = 0
+            oflag = 0
+            cflag = termios.CS8 | termios.CREAD | termios.CLOCAL
+            lflag = 0
+            termios.tcsetattr(self.fd, termios.TCSANOW, [iflag, oflag, cflag, lflag, speed, speed, cc])
+        except (EnvironmentError, termios.error):
+            # e.g. not a terminal
+            self.discard()
+            raise
+
+    def discard(self):
+        os.close(self.fd)
+
+    def close(self):
+        super(SerialSource, self).close()
+        self.discard()
+
+
+class TCPSource(StreamSource):
+    """
+    TCP connection to a device or service that serves NMEA, e.g. a WiFi
+    multiplexer or another distrib_nmea server
+    """
+
+    def __init__(self, tag, host, port, timeout=2.0):
+        super(TCPSource, self).__init__(tag)
+        self.address = (host, port)
+        self.connect_timeout = timeout
+        self.sock = None
+
+    def open(self):
+        family, socktype, proto, _, address = socket.getaddrinfo(self.address[0], self.address[1],
+                                                                 0, socket.SOCK_STREAM)[0]
+        self.sock = socket.socket(family, socktype, proto)
+        self.sock.setblocking(0)
+        self.fd = self.sock.fileno()
+        # the connection is completed while the server carries on
+        error = self.sock.connect_ex(address)
+        if error in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EINTR):
+            self.connecting = True
+        elif error:
+            self.discard()
+            raise socket.error(error, os.strerror(error))
+
+    def connected(self, now):
+        self.connecting = False
+        error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self.discard()
+            self.failed(now)
+            return False
+        self.opened()
+        return True
+
+    def readinto(self, view):
+        return self.sock.recv_into(view)
+
+    def discard(self):
+        self.sock.close()
+
+    def close(self):
+        super(TCPSource, self).close()
+        self.discard()
+
+
+class UDPSource(Source):
+    """
+    UDP listener. Each datagram holds one or more complete sentences.
+    """
+
+    def __init__(self, tag, port, host=''):
+        super(UDPSource, self).__init__(tag)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.setblocking(0)
+        self.fd = self.sock.fileno()
+
+    def read(self):
+        try:
+            data = self.sock.recv(65536)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise
+        lines = data.split('\n')
+        if lines[-1] == '':
+            lines.pop()
+        lines = [line + '\n' for line in lines]
+        self.sentences += len(lines)
+        return lines
+
+    def close(self):
+        super(UDPSource, self).close()
+        self.sock.close()
+
+
+def reopen_sources(waiting, now):
+    """
+    Try to reopen the closed sources in waiting. Returns the sources that
+    are open again, which are removed from waiting, and the number of
+    seconds until the next attempt is due (None if nothing is waiting).
+    """
+
+    reopened = []
+    for source in list(waiting):
+        if source.reopen(now):
+            waiting.remove(source)
+            reopened.append(source)
+    timeout = None
+    if waiting:
+        timeout = max(0.0, min(source.next_attempt for source in waiting) - now)
+    return reopened, timeout
+
+
+def connect_sources(waiting, writeable, now):
+    """
+    Finish the connections of the sources in waiting that select found
+    writeable. Returns the sources that are now open, which are removed
+    from waiting.
+    """
+
+    opened = []
+    for source in list(waiting):
+        if source.connecting and source in writeable and source.connected(now):
+            waiting.remove(source)
+            opened.append(source)
+    return opened
+
+
+def open_source(description, now):
+    """
+    Open the source given by a [tag=]kind:address description. Sources
+    that can be reopened are returned closed if they cannot be opened yet,
+    to be retried.
+    """
+
+    source = make_source(description)
+    if source.reopenable():
+        source.start(now)
+    return source
+
+
+def make_source(description):
+
+    tag = description
+    if '=' in description:
+        tag, description = description.split('=', 1)
+    kind, _, address = description.partition(':')
+    parts = address.split(':')
+    if kind == 'fifo':
+        return FifoSource(tag, address)
+    elif kind == 'serial':
+        if len(parts) > 1:
+            return SerialSource(tag, parts[0], int(parts[1]))
+        return SerialSource(tag, parts[0])
+    elif kind == 'udp':
+        if len(parts) > 1:
+            return UDPSource(tag, int(parts[1]), parts[0])
+        return UDPSource(tag, int(parts[0]))
+    elif kind == 'tcp':
+        if len(parts) != 2:
+            raise ValueError("TCP source must be tcp:host:port")
+        return TCPSource(tag, parts[0], int(parts[1]))
+    raise ValueError("Unknown source %s" % description)
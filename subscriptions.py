@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+"""
+Client subscriptions.
+
+A client that only wants some of the sentences sends a subscription
+request, one line of text, after it connects:
+
+    SUBSCRIBE sentence=GPRMC,GPGGA talker=AI ais=1,5 mmsi=503633801,503633800 decimate=HDT:1
+
+sentence    sentence addresses (talker + formatter) to send
+talker      talkers to send, e.g. GP for every GPS sentence
+ais         AIS message types to send
+mmsi        vessels to send AIS messages for
+decimate    address:seconds pairs, send at most one sentence with this
+            address (or formatter, e.g. HDT) every so many seconds
+box         south,west,north,east: send AIS messages only for vessels
+            last reported inside this box
+radius      latitude,longitude,nm: ... or within nm of this point
+
+Every key is optional. A sentence is sent if its address matches one of the
+sentences or talkers given (or neither key is given), and, for AIS
+sentences, if its message type and MMSI are among those given. A new
+request replaces the previous one, and SUBSCRIBE on its own restores the
+full feed.
+"""
+
+from geo import parse_area
+
+
+class SubscriptionError(Exception):
+    pass
+
+
+class AddressTrie(object):
+    """
+    Prefix tree of sentence addresses. A talker such as GP is simply a
+    short prefix of every GP sentence address.
+    """
+
+    def __init__(self, prefixes=()):
+        self.root = {}
+        for prefix in prefixes:
+            self.add(prefix)
+
+    def add(self, prefix):
+        node = self.root
+        for c in prefix:
+            node = node.setdefault(c, {})
+        # an empty key marks the end of a prefix
+        node[''] = True
+
+    def matches(self, address):
+        node = self.root
+        for c in address:
+            if '' in node:
+                return True
+            node = node.get(c)
+            if node is None:
+                return False
+        return '' in node
+
+    def __len__(self):
+        return len(self.root)
+
+
+class PriorityLanes(object):
+    """
+    Sorts sentences into priority lanes by address. Each lane is a list
+    of sentence addresses and talkers, highest priority first; sentences
+    that match none of them go in a last, lowest priority, lane.
+    """
+
+    def __init__(self, lanes):
+        self.tries = [AddressTrie([p.upper().lstrip('$!') for p in lane]) for lane in lanes]
+
+    def lane(self, address):
+        for i, trie in enumerate(self.tries):
+            if trie.matches(address):
+                return i
+        return len(self.tries)
+
+    def __len__(self):
+        return len(self.tries) + 1
+
+
+def parse_intervals(terms):
+    """
+    Turn address:seconds terms into a dictionary of decimation intervals
+    """
+
+    intervals = {}
+    for term in terms:
+        address, _, seconds = term.partition(':')
+        try:
+            intervals[address.upper().lstrip('$!')] = float(seconds)
+        except ValueError:
+            raise SubscriptionError("Bad decimation interval %s" % term)
+    return intervals
+
+
+class Decimator(object):
+    """
+    Limits how often sentences of a given address are sent to one client.
+
+    Instead of queueing every update of a high frequency sentence (heading,
+    attitude) only the newest one is kept in a slot for its address, and it
+    is sent once the interval since the last one sent has passed. Times
+    are from latency.monotonic, so a step of the system clock does not
+    hold a sentence back for the length of the step.
+    """
+
+    def __init__(self, intervals):
+        # address or formatter : seconds
+        self.intervals = intervals
+        # address : newest sentence not yet sent
+        self.slots = {}
+        # address : time the next sentence may be sent
+        self.due = {}
+        self.replaced = 0
+
+    def interval(self, address):
+        interval = self.intervals.get(address)
+        if interval is None:
+            interval = self.intervals.get(address[2:])
+        return interval
+
+    def offer(self, address, sentence, now):
+        """
+        Return True if the sentence can be sent now. Otherwise it is kept,
+        replacing any older sentence with the same address.
+        """
+
+        interval = self.interval(address)
+        if interval is None:
+            return True
+        if now >= self.due.get(address, 0.0):
+            self.due[address] = now + interval
+            if self.slots.pop(address, None) is not None:
+                self.replaced += 1
+            return True
+        if address in self.slots:
+            self.replaced += 1
+        self.slots[address] = sentence
+        return False
+
+    def flush(self, now):
+        """
+        Return the kept sentences that are now due
+        """
+
+        sentences = []
+        for address, sentence in self.slots.items():
+            if now >= self.due[address]:
+                sentences.append(sentence)
+                self.due[address] = now + self.interval(address)
+                del self.slots[address]
+        return sentences
+
+    def next_due(self):
+        # time the next kept sentence falls due, None if nothing is kept
+        if not self.slots:
+            return None
+        return min(self.due[address] for address in self.slots)
+
+
+class Subscription(object):
+    """
+    Compiled form of a subscription request
+    """
+
+    KEYS = ('sentence', 'talker', 'ais', 'mmsi', 'decimate', 'box', 'radius')
+
+    def __init__(self, sentences=(), talkers=(), ais_types=(), mmsis=(), intervals=None, area=None):
+        self.addresses = AddressTrie(list(sentences) + list(talkers))
+        self.ais_types = frozenset(ais_types)
+        self.mmsis = frozenset(mmsis)
+        # decimation intervals that override the server's defaults
+        self.intervals = intervals or {}
+        # geographic Area, which must be added to the server's AreaIndex
+        self.area = area
+
+    @classmethod
+    def parse(cls, request):
+        """
+        Build a Subscription from a SUBSCRIBE request line.
+        Raises SubscriptionError if the request is not understood.
+        """
+
+        words = request.split()
+        if not words or words[0].upper() != 'SUBSCRIBE':
+            raise SubscriptionError("Not a subscription request")
+        values = dict((key, []) for key in cls.KEYS)
+        for word in words[1:]:
+            key, _, value = word.partition('=')
+            key = key.lower()
+            if key not in values or not value:
+                raise SubscriptionError("Bad subscription term %s" % word)
+            values[key].extend(v for v in value.split(',') if v)
+        area = None
+        if values['box'] and values['radius']:
+            raise SubscriptionError("Only one of box and radius may be given")
+        for key in ('box', 'radius'):
+            if values[key]:
+                try:
+                    area = parse_area(key, values[key])
+                except ValueError as e:
+                    raise SubscriptionError(str(e))
+        try:
+            return cls(sentences=[s.upper().lstrip('$!') for s in values['sentence']],
+                       talkers=[t.upper() for t in values['talker']],
+                       ais_types=[int(t) for t in values['ais']],
+                       mmsis=[int(m) for m in values['mmsi']],
+                       intervals=parse_intervals(values['decimate']),
+                       area=area)
+        except ValueError:
+            raise SubscriptionError("AIS types and MMSIs must be numbers")
+
+    def matches(self, info):
+        """
+        Return True if the sentence described by info should be sent
+        """
+
+        if len(self.addresses) and not self.addresses.matches(info.address):
+            return False
+        if info.ais_type is not None:
+            if self.ais_types and info.ais_type not in self.ais_types:
+                return False
+            if self.mmsis and info.mmsi not in self.mmsis:
+                return False
+            if self.area is not None and (info.areas is None or self.area not in info.areas):
+                return False
+        return True
+
+    def matches_at(self, info, position):
+        """
+        matches() for a sentence about a vessel last reported at position
+        (None if not known), e.g. one kept for the latest state, rather
+        than one placed in the areas by the AreaIndex as it arrived
+        """
+
+        if self.area is None or info.ais_type is None:
+            return self.matches(info)
+        if len(self.addresses) and not self.addresses.matches(info.address):
+            return False
+        if self.ais_types and info.ais_type not in self.ais_types:
+            return False
+        if self.mmsis and info.mmsi not in self.mmsis:
+            return False
+        return position is not None and self.area.contains(position[0], position[1])
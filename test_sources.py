@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+"""
+Tests for sources.py, run with python -m unittest test_sources
+"""
+
+import os
+import socket
+import unittest
+
+import sources
+
+
+class OpenSourceTest(unittest.TestCase):
+
+    def test_udp_source(self):
+        source = sources.open_source('udp:127.0.0.1:0', 0.0)
+        self.addCleanup(source.close)
+        self.assertFalse(source.reopenable())
+        self.assertFalse(source.closed)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sender.close)
+        sender.sendto('$IIMWV,045.0,R,12.6,N,A*09\r\n', source.sock.getsockname())
+        self.assertEqual(source.read(), ['$IIMWV,045.0,R,12.6,N,A*09\r\n'])
+
+    def test_pipe_source(self):
+        read_fd, write_fd = os.pipe()
+        source = sources.PipeSource('worker 0', read_fd)
+        self.assertFalse(source.reopenable())
+        os.write(write_fd, '$IIMWV,045.0,R,12.6,N,A*09\r\n')
+        os.close(write_fd)
+        self.assertEqual(source.read(), ['$IIMWV,045.0,R,12.6,N,A*09\r\n'])
+        self.assertTrue(source.closed)
+
+    def test_fifo_source_is_reopenable(self):
+        source = sources.open_source('fifo:/nonexistent/nmea_fifo', 0.0)
+        self.assertTrue(source.reopenable())
+        self.assertTrue(source.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,4 @@
 #!/bin/bash
 
-./follow_route.py  -m 503633800 -n "TRILOGY" -s 6.0 -f ./lbg_route.json > ./nmea_fifo
+[ -p ./trilogy_fifo ] || mkfifo ./trilogy_fifo
+./follow_route.py  -m 503633800 -n "TRILOGY" -s 6.0 -f ./lbg_route.json > ./trilogy_fifo
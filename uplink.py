@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+"""
+Compressed uplink to a shore station.
+
+Sending each sentence as its own TCP segment over a satellite or cellular
+link wastes most of the (expensive) bandwidth on headers. Clients that
+connect to the server's --uplink-port instead receive the stream in
+batches, one every few seconds, compressed with a single zlib stream that
+stays open for the life of the connection so that each batch benefits
+from everything sent before it. Within a batch only the newest position
+report of each vessel is kept, and a report is left out altogether if
+the vessel's position, speed and course have not changed since the last
+one sent.
+
+On shore this program restores a plain NMEA stream, e.g. into the FIFO
+of a shore-side server:
+
+    ./uplink.py boat.example.com:10002 > ./nmea_fifo
+"""
+
+import argparse
+import socket
+import sys
+import time
+import zlib
+
+import aislib
+
+# AIS position reports (class A)
+POSITION_TYPES = (1, 2, 3)
+
+
+def position_key(payload):
+    """
+    The part of a class A position report that describes where the vessel
+    is and what it is doing: status, rate of turn, speed, accuracy,
+    position, course and heading (bits 38 to 136). The time stamp and
+    radio status after it change with every report.
+    """
+
+    bits = 0
+    for c in payload[:23]:
+        bits = (bits << 6) | aislib.re_encodingchars.get(c, 0)
+    # 23 characters hold bits 0 - 137, bit 137 is the top of the time stamp
+    return (bits >> 1) & ((1 << 99) - 1)
+
+
+class UplinkEncoder(object):
+    """
+    Turns batches of sentences into compressed uplink data
+    """
+
+    def __init__(self, level=9):
+        self.compressor = zlib.compressobj(level)
+        # mmsi : position key last sent
+        self.positions = {}
+        self.sentences_in = 0
+        self.sentences_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def thin(self, sentences, infos):
+        """
+        Keep only the newest position report of each vessel in the batch,
+        and only if it differs from the last one sent
+        """
+
+        newest = {}
+        for i, info in enumerate(infos):
+            if info is not None and info.ais_type in POSITION_TYPES:
+                newest[info.mmsi] = i
+        kept = []
+        for i, (sentence, info) in enumerate(zip(sentences, infos)):
+            if info is not None and info.ais_type in POSITION_TYPES:
+                if newest[info.mmsi] != i:
+                    continue
+                fields = sentence.split(',', 6)
+                if len(fields) > 5 and fields[1] == '1':
+                    key = position_key(fields[5])
+                    if self.positions.get(info.mmsi) == key:
+                        continue
+                    self.positions[info.mmsi] = key
+            kept.append(sentence)
+        return kept
+
+    def encode(self, sentences, infos=None):
+        """
+        Return the compressed data for a batch of sentences. infos, the
+        SentenceInfo of each sentence (or None where it is not known),
+        enables the position thinning.
+        """
+
+        self.sentences_in += len(sentences)
+        if infos is not None:
+            sentences = self.thin(sentences, infos)
+        data = ''.join(sentences)
+        self.sentences_out += len(sentences)
+        self.bytes_in += len(data)
+        compressed = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.bytes_out += len(compressed)
+        return compressed
+
+    def __str__(self):
+        ratio = 0.0
+        if self.bytes_out:
+            ratio = float(self.bytes_in) / self.bytes_out
+        return "%d of %d sentences sent, %d bytes compressed to %d (%.1f:1)" % \
+            (self.sentences_out, self.sentences_in, self.bytes_in, self.bytes_out, ratio)
+
+
+def receive(host, port, out, retry=10.0):
+    """
+    Connect to the uplink, decompress it and write the sentences to out,
+    reconnecting whenever the link drops
+    """
+
+    while True:
+        try:
+            sock = socket.create_connection((host, port))
+        except socket.error as e:
+            print >>sys.stderr, "Cannot connect to %s:%d: %s" % (host, port, e)
+            time.sleep(retry)
+            continue
+        print >>sys.stderr, "Connected to %s:%d" % (host, port)
+        decompressor = zlib.decompressobj()
+        try:
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                out.write(decompressor.decompress(data))
+                out.flush()
+        except (socket.error, zlib.error) as e:
+            print >>sys.stderr, "Uplink failed: %s" % e
+        sock.close()
+        print >>sys.stderr, "Uplink closed, reconnecting"
+        time.sleep(retry)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Receive the compressed uplink and write plain NMEA to stdout')
+    parser.add_argument('address', help='host:port of the boat\'s uplink port')
+    parser.add_argument('-r', '--retry', default=10.0, type=float, help='seconds between reconnection attempts')
+    args = parser.parse_args()
+
+    host, port = args.address.rsplit(':', 1)
+    try:
+        receive(host, int(port), sys.stdout, args.retry)
+    except (IOError, KeyboardInterrupt):
+        pass
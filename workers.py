@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+"""
+Multi-process distribution.
+
+For installations with hundreds of viewers one select loop on one core is
+not enough. With server.py --workers N the server forks N worker processes
+which all listen on the same TCP port (SO_REUSEPORT), so the kernel shares
+the incoming connections out between them. The original process becomes
+the ingest process: it alone reads the sources and applies the ingest
+stages (validation, duplicate filter, recorder, collision alarms), then
+writes each batch to every worker through a pipe. Every worker receives
+the sentences in the same order, so clients see the same stream whichever
+worker they are connected to, with one exception: a worker that falls so
+far behind that its pipe backs up past max_buffer misses whole batches,
+which are counted against it (nmea_worker_dropped_total on the ingest
+process's stats port).
+"""
+
+import collections
+import errno
+import fcntl
+import os
+import select
+import signal
+import socket
+import sys
+import time
+
+from sources import connect_sources, reopen_sources
+
+# Not exported by Python 2's socket module
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+
+class WorkerPipe(object):
+    """
+    Write end of the pipe to one worker. Output the worker has not yet
+    read is buffered, up to max_buffer bytes; beyond that whole batches
+    are dropped rather than blocking the other workers.
+    """
+
+    def __init__(self, pid, fd, max_buffer=1 << 20):
+        self.pid = pid
+        self.fd = fd
+        self.max_buffer = max_buffer
+        # batches not yet written, so a backlog is not copied on every write
+        self.pending = collections.deque()
+        self.pending_bytes = 0
+        self.dropped = 0
+        self.closed = False
+
+    def fileno(self):
+        return self.fd
+
+    def queue(self, data):
+        if self.pending_bytes + len(data) > self.max_buffer:
+            self.dropped += data.count('\n')
+            return
+        self.pending.append(data)
+        self.pending_bytes += len(data)
+
+    def flush(self):
+        pending = self.pending
+        while pending:
+            try:
+                written = os.write(self.fd, pending[0])
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return
+                # the worker has gone
+                self.close()
+                return
+            self.pending_bytes -= written
+            if written < len(pending[0]):
+                pending[0] = pending[0][written:]
+                return
+            pending.popleft()
+
+    def close(self):
+        if not self.closed:
+            os.close(self.fd)
+            self.closed = True
+            self.pending.clear()
+            self.pending_bytes = 0
+
+
+def start_workers(count):
+    """
+    Fork count workers. Returns (worker number, read end of its pipe) in
+    each worker, and (None, list of WorkerPipes) in the ingest process.
+    """
+
+    pipes = []
+    for number in range(count):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(write_fd)
+            for pipe in pipes:
+                os.close(pipe.fd)
+            return number, read_fd
+        os.close(read_fd)
+        # a worker that stops reading must not hold up the others
+        fcntl.fcntl(write_fd, fcntl.F_SETFL, fcntl.fcntl(write_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        pipes.append(WorkerPipe(pid, write_fd))
+    return None, pipes
+
+
+def listen_shared(port, backlog=5):
+    """
+    Listening socket that shares its port with the other workers
+    """
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.setblocking(0)
+    sock.bind(('', port))
+    sock.listen(backlog)
+    return sock
+
+
+def run_ingest(sources, pipes, ingest, stats_server=None):
+    """
+    The ingest process's event loop. ingest(sentences, now, tag) applies
+    the ingest stages to a batch read from the source with the given tag
+    and returns the sentences to distribute. stats_server, a StatsServer,
+    serves the ingest process's metrics.
+    Sources that fail are reopened, so it returns only when every source
+    that cannot be reopened, or every worker, has gone.
+    """
+
+    def stop(signum, frame):
+        for pipe in pipes:
+            os.kill(pipe.pid, signal.SIGTERM)
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    def report(signum, frame):
+        # pass the request for statistics on to the workers
+        for pipe in pipes:
+            print >>sys.stderr, "Worker %d: %d sentences dropped by the ingest process" % (pipe.pid, pipe.dropped)
+            os.kill(pipe.pid, signal.SIGUSR1)
+
+    signal.signal(signal.SIGUSR1, report)
+
+    # sources that could not be opened at startup, or are still connecting,
+    # are retried like those that fail
+    reopening = [source for source in sources if source.closed]
+    for source in reopening:
+        sources.remove(source)
+
+    def close(source):
+        sources.remove(source)
+        if not source.closed:
+            source.close()
+        if source.reopenable():
+            reopening.append(source)
+
+    while (sources or reopening) and any(not pipe.closed for pipe in pipes):
+        writing = [pipe for pipe in pipes if pipe.pending and not pipe.closed]
+        timeout = None
+        if reopening:
+            reopened, timeout = reopen_sources(reopening, time.time())
+            for source in reopened:
+                print >>sys.stderr, "%s has been reopened" % source
+                sources.append(source)
+        connecting = [source for source in reopening if source.connecting]
+        stats_readers = stats_writers = []
+        if stats_server is not None:
+            due = stats_server.schedule(time.time())
+            if due is not None and (timeout is None or due < timeout):
+                timeout = due
+            stats_readers = stats_server.readers()
+            stats_writers = stats_server.writers()
+        try:
+            readable, writeable, exceptional = select.select(sources + stats_readers,
+                                                             writing + stats_writers + connecting, sources, timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+
+        for s in stats_readers:
+            if s in readable:
+                stats_server.read(s, time.time())
+        for s in stats_writers:
+            if s in writeable:
+                stats_server.write(s)
+
+        for source in connect_sources(reopening, writeable, time.time()):
+            print >>sys.stderr, "%s has connected" % source
+            sources.append(source)
+
+        for source in readable:
+            if source in stats_readers:
+                continue
+            sentences = ingest(source.read(), time.time(), source.tag)
+            if sentences:
+                data = ''.join(sentences)
+                for pipe in pipes:
+                    if not pipe.closed:
+                        pipe.queue(data)
+                        pipe.flush()
+            if source.closed:
+                print >>sys.stderr, "%s has closed after %d sentences" % (source, source.sentences)
+                close(source)
+
+        for pipe in writeable:
+            if pipe in writing:
+                pipe.flush()
+
+        for source in exceptional:
+            if source in sources:
+                print >>sys.stderr, "%s has failed" % source
+                close(source)
+
+    # closing the pipes tells the workers there is nothing more to come
+    for pipe in pipes:
+        pipe.close()
+    for pipe in pipes:
+        try:
+            os.waitpid(pipe.pid, 0)
+        except OSError:
+            pass